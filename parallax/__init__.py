@@ -1,38 +1,70 @@
-import sys
-import logging
-import matplotlib.pyplot as plt
-
-import pandas as pd
+"""Importing the package is kept cheap - no matplotlib, boto3, astropy or pandas until they're needed - since
+every worker process that `tools.parallel` starts has to import it too. Submodules are loaded the first time
+they're used, so `parallax.data` and the like still work as attributes.
+"""
+import importlib
 import scipy as sp
-import matplotlib.pyplot as plt 
-from .aws import ec2
-from . import data, specnorm, tools
+from . import metrics
 from logging import getLogger
 
 log = getLogger(__name__)
 
+SUBMODULES = ['aws', 'binning', 'blocked', 'cannon', 'catalog', 'dag', 'data', 'galactic', 'metrics', 'parallax', 'rotation', 'specnorm', 'tools', 'xmatch']
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def configure():
+    """The interactive conveniences that used to happen as a side effect of importing `tools`"""
+    import sys
+    import logging
+    import matplotlib.pyplot as plt
+    plt.rcParams['figure.figsize'] = (12, 8)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
 def run_local():
+    from .aws import ec2
+    configure()
     instance = ec2.request_spot('python', .25, script=ec2.CONFIG, image='python-ec2')
     sess = ec2.session(instance)
 
+@metrics.timed(items=len)
 def parent_sample(catalog):
-    cuts = {'upper_g': catalog.apogee.logg <= 2.2,
-            'nonnull_g': catalog.apogee.logg > 0., # there are a few values less than zero that are not null
-            'nonnull_k': catalog.apogee.k > 0,
-            'nonnull_bp_rp': sp.isfinite(catalog.gaia.bp_rp),
-            'nonnull_w1mpro': sp.isfinite(catalog.wise.w1mpro),
-            'nonnull_w2mpro': sp.isfinite(catalog.wise.w2mpro),
-            'nonvariable': catalog.gaia.phot_variable_flag != 'VARAIBLE',
-            'nonduplicate': ~catalog.tmass.tmass_id.duplicated(),
-            'photometry_jk': (catalog.apogee.j - catalog.apogee.k) < (.4 + .45*catalog.gaia.bp_rp),
-            'photometry_hw': (catalog.apogee.h - catalog.wise.w2mpro) > -.05,
-            'finite_jhk': catalog.apogee[['j', 'h', 'k']].gt(-100).all(1),
-            'positive_jhk_err': catalog.apogee[['j_err', 'h_err', 'k_err']].gt(0).all(1),
-            'finite_wise': catalog.wise[['w1mpro', 'w2mpro']].apply(sp.isfinite).all(1),
-            'positive_wise_err': catalog.wise[['w1mpro_error', 'w2mpro_error']].gt(0).all(1)}
+    from . import tools
+    cuts = {'upper_g': lambda c: c.apogee.logg <= 2.2,
+            'nonnull_g': lambda c: c.apogee.logg > 0., # there are a few values less than zero that are not null
+            'nonnull_k': lambda c: c.apogee.k > 0,
+            'nonnull_bp_rp': lambda c: sp.isfinite(c.gaia.bp_rp),
+            'nonnull_w1mpro': lambda c: sp.isfinite(c.wise.w1mpro),
+            'nonnull_w2mpro': lambda c: sp.isfinite(c.wise.w2mpro),
+            'nonvariable': lambda c: c.gaia.phot_variable_flag != 'VARAIBLE',
+            'nonduplicate': tools.whole(lambda c: ~c.tmass.tmass_id.duplicated()),
+            'photometry_jk': lambda c: (c.apogee.j - c.apogee.k) < (.4 + .45*c.gaia.bp_rp),
+            'photometry_hw': lambda c: (c.apogee.h - c.wise.w2mpro) > -.05,
+            'finite_jhk': lambda c: c.apogee[['j', 'h', 'k']].gt(-100).all(1),
+            'positive_jhk_err': lambda c: c.apogee[['j_err', 'h_err', 'k_err']].gt(0).all(1),
+            'finite_wise': lambda c: c.wise[['w1mpro', 'w2mpro']].apply(sp.isfinite).all(1),
+            'positive_wise_err': lambda c: c.wise[['w1mpro_error', 'w2mpro_error']].gt(0).all(1)}
     return tools.cut(catalog, cuts)
 
+def pipeline():
+    from . import dag, data, parallax, specnorm
+    # The catalog and the spectra manage their own caches
+    return [
+        dag.Stage('catalog', data.load_catalog, cache=False),
+        dag.Stage('parent', parent_sample, inputs=['catalog']),
+        dag.Stage('training', parallax.training_catalog, inputs=['parent']),
+        dag.Stage('spectra', data.load_spectra, inputs=['parent'], cache=False),
+        dag.Stage('normed', specnorm.normalize, inputs=['spectra']),
+        dag.Stage('model', parallax.fit_training, inputs=['training', 'normed']),
+        # Storing the spectra pixel-major means predicting only reads the pixels the model uses
+        dag.Stage('stored', data.store_spectra, inputs=['normed'], cache=False),
+        dag.Stage('predictions', parallax.predict, inputs=['model', 'parent', 'stored'])]
+
+@metrics.timed()
 def run_remote():
-    catalog = parent_sample(data.load_catalog())
-    spectra = data.load_spectra(catalog)
-    normed = specnorm.normalize(spectra)
\ No newline at end of file
+    from . import dag, data
+    configure()
+    return dag.run(pipeline(), codec=data.CODEC)
\ No newline at end of file
@@ -1,4 +1,10 @@
 import json
 
-def config(key):
-    return json.load(open('config.json'))[key]
\ No newline at end of file
+def config(key, default=None):
+    value = json.load(open('config.json')).get(key, default)
+    if value is None:
+        raise KeyError(f'"{key}" is not set in config.json')
+    return value
+
+# Running totals of the bytes passed through the storage backends, for `parallax.metrics`
+BYTES = {'read': 0, 'written': 0}
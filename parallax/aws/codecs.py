@@ -0,0 +1,56 @@
+"""Compression codecs for objects stored through `s3.Path`. The codec used to write an object is
+recorded in its metadata, so reading it back is transparent.
+
+Both codecs are optional dependencies; install `zstandard` or `lz4` to use them.
+"""
+import logging
+import importlib.util
+
+log = logging.getLogger(__name__)
+
+__all__ = ('compress', 'decompress', 'available', 'CODECS')
+
+# Blobs bigger than this get compressed on all cores. Below it, the thread startup isn't worth it.
+THREADED_SIZE = 16*2**20
+
+def _zstd_compress(data, level):
+    import zstandard
+    threads = -1 if len(data) > THREADED_SIZE else 0
+    return zstandard.ZstdCompressor(level=level, threads=threads).compress(data)
+
+def _zstd_decompress(data):
+    import zstandard
+    # The streaming decompressor doesn't need the content size to be written into the frame header
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+def _lz4_compress(data, level):
+    import lz4.frame
+    return lz4.frame.compress(data, compression_level=level)
+
+def _lz4_decompress(data):
+    import lz4.frame
+    return lz4.frame.decompress(data)
+
+# name: (compress, decompress, default level)
+CODECS = {
+    'zstd': (_zstd_compress, _zstd_decompress, 3),
+    'lz4': (_lz4_compress, _lz4_decompress, 0)}
+
+# name: the module that has to be installed to use it
+MODULES = {'zstd': 'zstandard', 'lz4': 'lz4'}
+
+def available(codec):
+    """Whether `codec`'s module is installed. Doesn't import it."""
+    return importlib.util.find_spec(MODULES[codec]) is not None
+
+def compress(data, codec, level=None):
+    if codec not in CODECS:
+        raise ValueError(f'Unknown codec "{codec}"; choose from {", ".join(CODECS)}')
+    compressor, _, default = CODECS[codec]
+    return compressor(data, default if level is None else level)
+
+def decompress(data, codec):
+    if codec not in CODECS:
+        raise ValueError(f'Unknown codec "{codec}"; choose from {", ".join(CODECS)}')
+    _, decompressor, _ = CODECS[codec]
+    return decompressor(data)
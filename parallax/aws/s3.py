@@ -4,7 +4,7 @@ import json
 import pickle
 from io import BytesIO
 from contextlib import contextmanager
-from . import config
+from . import config, codecs, BYTES
 
 __all__ = ('Path',)
 
@@ -36,6 +36,9 @@ class Path(object):
 
     There is also a `write_multipart` function for streaming large files to S3. It works well with 
     requests' streaming capabilities.
+
+    Objects can be compressed on the way up by passing a codec, eg `write_bytes(data, codec='zstd')`.
+    The codec is stored in the object's metadata and `read_bytes` undoes it automatically.
     """
 
     def __init__(self, path):
@@ -47,8 +50,13 @@ class Path(object):
 
         self._object = self._bucket.Object(key)
     
-    def write_bytes(self, data):
-        self._object.upload_fileobj(BytesIO(data))
+    def write_bytes(self, data, codec=None, level=None):
+        if codec is None:
+            self._object.upload_fileobj(BytesIO(data))
+        else:
+            data = codecs.compress(data, codec, level)
+            self._object.upload_fileobj(BytesIO(data), ExtraArgs={'Metadata': {'codec': codec}})
+        BYTES['written'] += len(data)
     
     @contextmanager
     def write_multipart(self):
@@ -60,6 +68,7 @@ class Path(object):
             def write(data):
                 i = len(parts) + 1
                 parts[i] = uploader.Part(i).upload(Body=data)
+                BYTES['written'] += len(data)
             
             yield write
             
@@ -70,10 +79,16 @@ class Path(object):
             raise IOError('Multipart upload failed') from e
     
     def read_bytes(self):
-        data = BytesIO()
-        self._object.download_fileobj(data)
-        data.seek(0)
-        return data.read()
+        # The metadata comes back with the body, so there's no need for a separate HEAD to find the codec - 
+        # and no risk of it being stale
+        response = self._object.get()
+        data = response['Body'].read()
+        BYTES['read'] += len(data)
+
+        codec = (response.get('Metadata') or {}).get('codec')
+        if codec is None:
+            return data
+        return codecs.decompress(data, codec)
 
     def exists(self):
         try:
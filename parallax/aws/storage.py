@@ -0,0 +1,143 @@
+"""Storage backends sharing the `s3.Path` API. Which one `Path` hands out is decided by the `STORAGE`
+key in `config.json`, or the `PARALLAX_STORAGE` environment variable if it's set:
+
+  * `s3` stores everything on S3, as it always has.
+  * `local` stores everything as plain files under `STORAGE_ROOT`. Nothing gets compressed. Arrays written
+    with `LocalPath.write_array` - or as raw bytes - can be memmapped back; pickles can't.
+  * `memory` stores everything in a dict on this process. Handy for tests, but each process has its own
+    dict, so it doesn't work with `tools.parallel` process pools: workers won't see the parent's writes
+    and the parent won't see theirs.
+
+Paths are always written as `bucket/key`, whichever backend is in use.
+"""
+import os
+import logging
+import tempfile
+from pathlib import Path as _Path
+from contextlib import contextmanager
+from . import config, BYTES
+
+log = logging.getLogger(__name__)
+
+__all__ = ('Path', 'LocalPath', 'MemoryPath')
+
+def backend():
+    # config.json's only read if it's needed, so the environment variable works outside the repo root too
+    if 'PARALLAX_STORAGE' in os.environ:
+        return os.environ['PARALLAX_STORAGE']
+    return config('STORAGE', 's3')
+
+def Path(path):
+    name = backend()
+    if name == 's3':
+        # Imported lazily so that the offline backends don't need boto3
+        from .s3 import Path as S3Path
+        return S3Path(path)
+    elif name == 'local':
+        return LocalPath(path)
+    elif name == 'memory':
+        return MemoryPath(path)
+    raise ValueError(f'Unknown storage backend "{name}"; choose from s3, local, memory')
+
+class LocalPath(object):
+    """Stores objects as files under `root`, which defaults to the `STORAGE_ROOT` config value.
+
+    Codecs are accepted for compatibility with `s3.Path`, but ignored: the point of the local backend
+    is to be the fast one. Writes go to a temporary file of their own that's moved into place once it's
+    complete, so a crashed write never leaves a truncated object behind, and two writers to the same path
+    can't clobber each other's halves - whichever finishes last wins.
+    """
+
+    def __init__(self, path, root=None):
+        root = config('STORAGE_ROOT', 'cache/storage') if root is None else root
+        self._path = _Path(root) / path
+
+    @contextmanager
+    def _tempfile(self):
+        """Yields an open file next to this path, which is moved into place if the block succeeds and
+        deleted if it doesn't"""
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        f = tempfile.NamedTemporaryFile(dir=self._path.parent, prefix=self._path.name + '.', suffix='.tmp', delete=False)
+        try:
+            with f:
+                yield f
+            os.replace(f.name, self._path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+
+    def write_bytes(self, data, codec=None, level=None):
+        with self._tempfile() as f:
+            f.write(data)
+        BYTES['written'] += len(data)
+
+    @contextmanager
+    def write_multipart(self):
+        try:
+            with self._tempfile() as f:
+                def write(data):
+                    f.write(data)
+                    BYTES['written'] += len(data)
+                yield write
+        except Exception as e:
+            raise IOError('Multipart write failed') from e
+
+    def read_bytes(self):
+        data = self._path.read_bytes()
+        BYTES['read'] += len(data)
+        return data
+
+    def exists(self):
+        return self._path.is_file()
+
+    def local_path(self):
+        return self._path
+
+    def write_array(self, array):
+        """Writes `array` as a `.npy` file, which `memmap` can map straight back"""
+        import scipy as sp
+        with self._tempfile() as f:
+            sp.save(f, sp.asarray(array), allow_pickle=False)
+            size = f.tell()
+        BYTES['written'] += size
+
+    def memmap(self, dtype=None, shape=None, offset=0):
+        """Maps the file read-only. With no `dtype` it's taken to be a `.npy` file from `write_array`; 
+        otherwise it's read as raw values of `dtype`, starting `offset` bytes in."""
+        import scipy as sp
+        if dtype is None:
+            return sp.load(self._path, mmap_mode='r', allow_pickle=False)
+        return sp.memmap(self._path, dtype=dtype, mode='r', shape=shape, offset=offset)
+
+_memory = {}
+class MemoryPath(object):
+    """Stores objects in a module-level dict, so they last as long as the process does. The dict isn't 
+    shared with other processes, so don't use this backend with process pools."""
+
+    def __init__(self, path):
+        self._key = path
+
+    def write_bytes(self, data, codec=None, level=None):
+        _memory[self._key] = bytes(data)
+        BYTES['written'] += len(data)
+
+    @contextmanager
+    def write_multipart(self):
+        parts = []
+        try:
+            yield parts.append
+            _memory[self._key] = b''.join(parts)
+            BYTES['written'] += len(_memory[self._key])
+        except Exception as e:
+            raise IOError('Multipart write failed') from e
+
+    def read_bytes(self):
+        try:
+            data = _memory[self._key]
+        except KeyError:
+            raise FileNotFoundError(self._key)
+        BYTES['read'] += len(data)
+        return data
+
+    def exists(self):
+        return self._key in _memory
@@ -0,0 +1,170 @@
+"""Binned statistics for maps and rotation curves.
+
+The map-making scripts loop over every cell of a grid and mask the whole catalog each time, which is
+O(cells * stars). Here each star gets assigned to its cells once - as a list of `(star, cell)` pairs - and
+then every statistic is a `bincount` over those pairs, so the cost is O(stars) however fine the grid is.
+
+    bins = grid(mean_cart[:, 0], mean_cart[:, 1], sp.arange(-30, 30.01, .5), sp.arange(-30, 30.01, .5), half=.5)
+    bins = bins.select(cut_z)
+    n = bins.count()                                      # (121, 121)
+    mean_cyl = bins.nanmean(mean_cyl_n)                   # (121, 121, 6)
+    vvT = bins.moment(mean_cyl_n[:, 3:])                  # (121, 121, 3, 3)
+    error_var = bins.nanmean(cov_cyl_n)                   # (121, 121, 3, 3)
+
+Grid boxes can overlap, as they do in the scripts - boxes of half-width .5 every .5 kpc - in which case a
+star contributes to every box it falls in. Empty cells come out as NaN.
+
+`bootstrap` resamples the stars in every cell at once to get percentiles of the velocity dispersions:
+
+    vt = bootstrap(annuli(mean_cyl_n[:, 0], edges).select(cut), mean_cyl_n[:, 3:], cov_cyl_n)  # (3, n_annuli, 3, 3)
+"""
+import logging
+import scipy as sp
+import scipy.sparse
+from numpy.random import default_rng, SeedSequence
+from . import tools
+
+log = logging.getLogger(__name__)
+
+__all__ = ('Bins', 'grid', 'annuli', 'bootstrap')
+
+class Bins(object):
+    """A list of `(star, cell)` memberships, with the cells laid out in an array of `shape`"""
+
+    def __init__(self, star, cell, shape):
+        self.star = sp.asarray(star)
+        self.cell = sp.asarray(cell)
+        self.shape = tuple(shape)
+        self.size = int(sp.prod(self.shape))
+
+    def __len__(self):
+        return len(self.star)
+
+    def select(self, mask):
+        """Drops the stars that aren't in `mask`"""
+        keep = sp.asarray(mask, dtype=bool)[self.star]
+        return type(self)(self.star[keep], self.cell[keep], self.shape)
+
+    def count(self):
+        return sp.bincount(self.cell, minlength=self.size).reshape(self.shape)
+
+    def sum(self, values):
+        """Sums `values`, which can have any number of trailing dimensions, over the stars in each cell"""
+        values = sp.asarray(values, dtype=float)[self.star]
+        flat = values.reshape(len(values), -1)
+        sums = [sp.bincount(self.cell, flat[:, k], minlength=self.size) for k in range(flat.shape[1])]
+        return sp.stack(sums, -1).reshape(self.shape + values.shape[1:])
+
+    def _divide(self, total, n):
+        n = n.reshape(n.shape + (1,)*(total.ndim - n.ndim))
+        with sp.errstate(invalid='ignore', divide='ignore'):
+            return sp.where(n > 0, total/n, sp.nan)
+
+    def mean(self, values):
+        """Means over the stars in each cell. Any NaN in a cell makes its mean NaN."""
+        return self._divide(self.sum(values), self.count())
+
+    def nanmean(self, values):
+        """Means over the stars in each cell, ignoring NaNs element by element like `sp.nanmean` does"""
+        values = sp.asarray(values, dtype=float)
+        finite = sp.isfinite(values)
+        total = self.sum(sp.where(finite, values, 0))
+        return self._divide(total, self.sum(finite))
+
+    def moment(self, values):
+        """Mean of `v v^T` over the stars in each cell, for `(n, k)` values. Gives `(*shape, k, k)`."""
+        values = sp.asarray(values, dtype=float)
+        return self.mean(values[:, :, None]*values[:, None, :])
+
+def _candidates(x, centers, half):
+    """For each star, the indices of the evenly spaced `centers` it's strictly within `half` of, as an
+    `(n, m)` array of indices alongside an `(n, m)` mask of which are real"""
+    x, centers = sp.asarray(x, dtype=float), sp.asarray(centers, dtype=float)
+    step = centers[1] - centers[0] if len(centers) > 1 else 2*half
+    if len(centers) > 2 and not sp.allclose(sp.diff(centers), step):
+        raise ValueError('Centers must be evenly spaced')
+
+    # Overestimate the window by one either side and let the exact check sort out the edges
+    m = int(sp.ceil(2*half/step)) + 2
+    finite = sp.isfinite(x)
+    first = sp.floor((sp.where(finite, x, centers[0]) - half - centers[0])/step).astype(int)
+    index = first[:, None] + sp.arange(m)[None, :]
+    inside = (index >= 0) & (index < len(centers)) & finite[:, None]
+    index = sp.where(inside, index, 0)
+    inside &= abs(x[:, None] - centers[index]) < half
+    return index, inside
+
+def grid(x, y, xs, ys, half):
+    """Assigns each star to every box centred on `(xs[i], ys[j])` that it's strictly within `half` of in
+    both coordinates. The centres along each axis must be evenly spaced."""
+    ix, x_inside = _candidates(x, xs, half)
+    iy, y_inside = _candidates(y, ys, half)
+    inside = x_inside[:, :, None] & y_inside[:, None, :]
+    cell = ix[:, :, None]*len(ys) + iy[:, None, :]
+    star = sp.broadcast_to(sp.arange(len(inside))[:, None, None], inside.shape)
+    return Bins(star[inside], cell[inside], (len(xs), len(ys)))
+
+def annuli(r, edges):
+    """Assigns each star to the annulus `edges[i] < r < edges[i+1]` it falls in, if any"""
+    r, edges = sp.asarray(r, dtype=float), sp.asarray(edges, dtype=float)
+    index = sp.searchsorted(edges, r, side='left') - 1
+    valid = (index >= 0) & (index < len(edges) - 1)
+    index = sp.where(valid, index, 0)
+    valid &= (r > edges[index]) & (r < edges[index + 1])
+    return Bins(sp.flatnonzero(valid), index[valid], (len(edges) - 1,))
+
+def _weights(rng, cell, size, n_samples):
+    """Multinomial resampling weights for every cell at once, as an `(n_samples, len(cell))` array. Each
+    membership is replaced by a draw from the memberships in the same cell, so each replicate's weights
+    sum to the cell's count within each cell."""
+    order = sp.argsort(cell, kind='stable')
+    counts = sp.bincount(cell, minlength=size)
+    starts = sp.cumsum(counts) - counts
+
+    c = cell[order]
+    draws = starts[c] + (rng.random((n_samples, len(c)))*counts[c]).astype(int)
+    flat = sp.bincount((sp.arange(n_samples)[:, None]*len(c) + order[draws]).ravel(), minlength=n_samples*len(c))
+    return flat.reshape(n_samples, len(c))
+
+def _replicates(seed, n_samples, star, cell, size, v, cov):
+    """`vvT - <cov>` in every cell for `n_samples` bootstrap replicates"""
+    rng = default_rng(seed)
+    v, cov = v[star], cov[star]
+    finite = sp.isfinite(cov)
+    k = v.shape[1]
+
+    # Lay out everything that's summed as one sparse (memberships, cells * columns) matrix, so that the
+    # sums for every replicate and every cell come out of a single product with the weights.
+    columns = sp.concatenate([
+        (v[:, :, None]*v[:, None, :]).reshape(len(v), -1),
+        sp.where(finite, cov, 0).reshape(len(v), -1),
+        finite.reshape(len(v), -1)], 1)
+    width = columns.shape[1]
+    rows = sp.repeat(sp.arange(len(v)), width)
+    cols = (cell[:, None]*width + sp.arange(width)[None, :]).ravel()
+    M = sp.sparse.csr_matrix((columns.ravel(), (rows, cols)), shape=(len(v), size*width))
+
+    W = _weights(rng, cell, size, n_samples)
+    sums = (M.T @ W.T).T.reshape(n_samples, size, 3, k, k)
+    n = sp.bincount(cell, minlength=size)[None, :, None, None]
+    with sp.errstate(invalid='ignore', divide='ignore'):
+        return sums[:, :, 0]/n - sums[:, :, 1]/sums[:, :, 2]
+
+def bootstrap(bins, v, cov, n_samples=100, percentiles=(16, 50, 84), seed=42, chunk=25, N=0, **kwargs):
+    """Bootstraps the error-corrected velocity dispersion tensor `vvT - <cov>` of every cell in `bins`,
+    for `(n, k)` velocities `v` and their `(n, k, k)` error covariances `cov`. Returns the `percentiles`
+    over the replicates as a `(len(percentiles), *bins.shape, k, k)` array.
+
+    Replicates are drawn in chunks of `chunk`, each from its own child of `seed`, so the results are the
+    same however many workers there are. Pass `N` to spread the chunks over that many processes; any
+    other `kwargs` go to `tools.parallel`.
+    """
+    v, cov = sp.asarray(v, dtype=float), sp.asarray(cov, dtype=float)
+    sizes = [min(chunk, n_samples - i) for i in range(0, n_samples, chunk)]
+    seeds = SeedSequence(seed).spawn(len(sizes))
+    with tools.parallel(_replicates, N=N, progress=False, **kwargs) as p:
+        replicates = p.wait({i: p(s, n, bins.star, bins.cell, bins.size, v, cov) for i, (s, n) in enumerate(zip(seeds, sizes))})
+    replicates = sp.concatenate([replicates[i] for i in range(len(sizes))])
+
+    vt = sp.nanpercentile(replicates, percentiles, axis=0)
+    return vt.reshape((len(percentiles),) + bins.shape + vt.shape[-2:])
@@ -0,0 +1,117 @@
+"""A design matrix that lives on disk and is streamed through a block of rows at a time.
+
+The solvers only ever touch `X` through `X @ b`, `v @ X`, `X.shape` and row selections like `X[burnin]`, so
+anything that supports those can stand in for an array. `BlockedDesignMatrix` does, with the data memmapped
+from a file of float64s:
+
+    X, m, cols = parallax.blocked_design_matrix(training, normed, 'alj.data/parallax/X')
+    b = parallax.train(X, y, w, burnin=good, m=m)
+
+Each product reads the matrix once, front to back, and the next block is read on a background thread while
+the current one's being multiplied. Only a couple of blocks are ever in memory, so the training set can be
+several times bigger than RAM. It pickles down to its path and row selection, so it can be handed to
+`tools.parallel` workers too.
+
+The file always goes under the local storage root, whichever backend is configured, since it's scratch
+space that needs to be memmapped rather than an object worth keeping.
+"""
+import logging
+import scipy as sp
+from concurrent.futures import ThreadPoolExecutor
+from .aws import storage
+
+log = logging.getLogger(__name__)
+
+__all__ = ('BlockedDesignMatrix', 'write')
+
+# Roughly how big a block of rows to read at a time. Two are in memory at once: one being multiplied and
+# one being prefetched.
+BLOCK_BYTES = 2**27
+
+class BlockedDesignMatrix(object):
+    """The `(n, p)` float64 matrix stored at `path`, restricted to `rows` if they're given"""
+
+    # Makes numpy hand `v @ X` over to `__rmatmul__` rather than trying to turn this into an array
+    __array_ufunc__ = None
+
+    def __init__(self, path, shape, rows=None, block=None):
+        self.path = path
+        self._shape = tuple(shape)
+        self.rows = None if rows is None else sp.asarray(rows)
+        self.block = max(1, BLOCK_BYTES//(8*max(self._shape[1], 1))) if block is None else block
+        self._data = None
+
+    @property
+    def shape(self):
+        return (len(self), self._shape[1])
+
+    def __len__(self):
+        return self._shape[0] if self.rows is None else len(self.rows)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = storage.LocalPath(self.path).memmap(dtype=float, shape=self._shape)
+        return self._data
+
+    def _read(self, start):
+        stop = min(start + self.block, len(self))
+        if self.rows is None:
+            return sp.array(self.data[start:stop])
+        return self.data[self.rows[start:stop]]
+
+    def blocks(self):
+        """Yields each block's first row and its values, reading the next block while this one's used"""
+        if len(self) == 0:
+            return
+        with ThreadPoolExecutor(1) as pool:
+            future = pool.submit(self._read, 0)
+            for start in range(0, len(self), self.block):
+                block = future.result()
+                if start + self.block < len(self):
+                    future = pool.submit(self._read, start + self.block)
+                yield start, block
+
+    def __matmul__(self, b):
+        b = sp.asarray(b)
+        out = sp.empty((len(self),) + b.shape[1:])
+        for start, block in self.blocks():
+            out[start:start+len(block)] = block @ b
+        return out
+
+    def __rmatmul__(self, v):
+        v = sp.asarray(v)
+        out = sp.zeros(v.shape[:-1] + (self.shape[1],))
+        for start, block in self.blocks():
+            out += v[..., start:start+len(block)] @ block
+        return out
+
+    def __getitem__(self, key):
+        """Selects rows - by mask, index array or slice - without reading anything"""
+        if isinstance(key, tuple):
+            raise TypeError('Only rows can be selected from a BlockedDesignMatrix')
+        rows = sp.arange(len(self)) if self.rows is None else self.rows
+        return type(self)(self.path, self._shape, rows[key], self.block)
+
+    def __getstate__(self):
+        # The memmap's reopened on the other side rather than pickled
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __repr__(self):
+        return f'BlockedDesignMatrix({self.path}, {len(self)}x{self.shape[1]})'
+
+def write(blocks, path):
+    """Writes an iterable of `(rows, p)` arrays one after another to `path`, and returns the matrix they make
+    up. Only one block needs to be in memory at a time."""
+    n, p = 0, None
+    with storage.LocalPath(path).write_multipart() as append:
+        for block in blocks:
+            block = sp.ascontiguousarray(block, dtype=float)
+            if p is not None and block.shape[1] != p:
+                raise ValueError(f'Block has {block.shape[1]} columns but the earlier ones have {p}')
+            n, p = n + len(block), block.shape[1]
+            append(block.tobytes())
+    log.info(f'Wrote a {n}x{p} design matrix to {path}')
+    return BlockedDesignMatrix(path, (n, 0 if p is None else p))
@@ -0,0 +1,89 @@
+"""A linear Cannon: each pixel's normalized flux is modelled as a linear function of a few standardized labels,
+
+    flux[star, pixel] = coeffs[pixel] @ [1, *labels[star]]
+
+with each pixel fitted by inverse-variance-weighted least squares. The original fitted the pixels one at a
+time; here the normal equations of every pixel are built with a couple of matrix products into an
+`(n_pixels, p, p)` stack and solved in one batched call. The test step - inferring labels for new spectra -
+is batched the same way over stars.
+
+    model = train(normed.flux, 1/normed.error**2, labels[['k_abs', 'teff']])
+    inferred, errors = test(model, normed.flux, 1/normed.error**2)
+
+Fluxes and inverse variances are `(n_stars, n_pixels)`, as `specnorm.normalize` produces them.
+"""
+import logging
+import scipy as sp
+import pandas as pd
+from numpy.linalg import solve, inv
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+__all__ = ('Model', 'train', 'test')
+
+class Model(object):
+    """The coefficients of each pixel, along with what's needed to standardize labels the way they were in
+    training. `coeffs[:, 0]` is the flux at the mean labels."""
+
+    def __init__(self, coeffs, offsets, scales, names):
+        self.coeffs = coeffs
+        self.offsets = offsets
+        self.scales = scales
+        self.names = list(names)
+
+    def standardize(self, labels):
+        return (sp.asarray(labels, dtype=float) - self.offsets)/self.scales
+
+    def design(self, labels):
+        scaled = self.standardize(labels)
+        return sp.concatenate([sp.ones((len(scaled), 1)), scaled], 1)
+
+    def predict(self, labels):
+        """The model's fluxes for `labels`, as `(n_stars, n_pixels)`"""
+        return self.design(labels) @ self.coeffs.T
+
+    def __repr__(self):
+        return f'Model({len(self.coeffs)} pixels, labels={self.names})'
+
+def _names(labels):
+    return list(labels.columns) if isinstance(labels, pd.DataFrame) else list(range(sp.shape(labels)[1]))
+
+@metrics.timed(items=lambda m: len(m.coeffs))
+def train(flux, ivar, labels):
+    """Fits every pixel's coefficients against the `(n_stars, n_labels)` training `labels`"""
+    flux, ivar = sp.asarray(flux, dtype=float), sp.asarray(ivar, dtype=float)
+    values = sp.asarray(labels, dtype=float)
+    model = Model(None, values.mean(0), values.std(0), _names(labels))
+
+    A = model.design(values)
+    n, p = A.shape
+    # Each pixel's A.T @ diag(ivar) @ A is a weighted sum of the outer products of the rows of A, so all of
+    # them come out of one (n_pixels, n_stars) @ (n_stars, p*p) product
+    outer = (A[:, :, None]*A[:, None, :]).reshape(n, p*p)
+    ATA = (ivar.T @ outer).reshape(-1, p, p)
+    ATy = (ivar*flux).T @ A
+    model.coeffs = solve(ATA, ATy[:, :, None])[:, :, 0]
+    return model
+
+@metrics.timed(items=lambda r: len(r[0]))
+def test(model, flux, ivar):
+    """Infers the labels of each star from its spectrum. Returns the labels and their standard errors,
+    both as `(n_stars, n_labels)` frames if `flux` is a frame and arrays otherwise."""
+    index = flux.index if isinstance(flux, pd.DataFrame) else None
+    flux, ivar = sp.asarray(flux, dtype=float), sp.asarray(ivar, dtype=float)
+
+    # The model's linear in the labels, so each star's best fit is another weighted least squares - this
+    # time over pixels, with the coefficients as the design matrix
+    C = model.coeffs[:, 1:]
+    q = C.shape[1]
+    outer = (C[:, :, None]*C[:, None, :]).reshape(len(C), q*q)
+    CTC = (ivar @ outer).reshape(-1, q, q)
+    CTy = (ivar*(flux - model.coeffs[:, 0])) @ C
+    scaled = solve(CTC, CTy[:, :, None])[:, :, 0]
+
+    labels = scaled*model.scales + model.offsets
+    errors = sp.sqrt(sp.diagonal(inv(CTC), axis1=1, axis2=2))*model.scales
+    if index is not None:
+        return pd.DataFrame(labels, index, model.names), pd.DataFrame(errors, index, model.names)
+    return labels, errors
@@ -0,0 +1,160 @@
+"""A catalog that's stored column-by-column and only loads the columns that are actually used.
+
+The merged APOGEE x Gaia x WISE table has hundreds of columns, but the cuts and the fit only touch a few
+dozen of them. `Catalog` mimics just enough of the pandas interface - `catalog.gaia.parallax`,
+`catalog.apogee[['j', 'h', 'k']]`, `catalog[mask]`, `len(catalog)` - that the rest of the code can't tell
+the difference, but it fetches each column from storage the first time it's asked for. Passing `columns=`
+restricts it to a fixed set of columns up front, which makes any accidental use of another column an error.
+
+Each column is written to `{root}/{block}/{column}`, with the list of columns and the index - stored once, and
+shared by every column - in `{root}/index`. Plain numeric columns are written as bare `.npy` arrays, so a column
+of floats costs eight bytes a row; anything numpy can't hold natively, like strings, is pickled.
+"""
+import pickle
+import hashlib
+from io import BytesIO
+import logging
+import scipy as sp
+import pandas as pd
+from .aws import storage
+
+log = logging.getLogger(__name__)
+
+__all__ = ('Catalog', 'store')
+
+def _encode(series):
+    if series.dtype.kind in 'biufcmM':
+        buffer = BytesIO()
+        sp.save(buffer, series.values, allow_pickle=False)
+        return buffer.getvalue()
+    return pickle.dumps(series)
+
+def _decode(data, index, name):
+    # Stores written before columns were saved as arrays have pickled series throughout
+    if data.startswith(b'\x93NUMPY'):
+        return pd.Series(sp.load(BytesIO(data), allow_pickle=False), index=index, name=name)
+    return pickle.loads(data)
+
+def store(df, root, codec=None):
+    """Splits a dataframe with (block, column) columns into a column store under `root`"""
+    # A hash of everything that's written, so a catalog can tell whether the store's been rebuilt
+    md5 = hashlib.md5()
+    for block, column in df.columns:
+        # Going through `df[block]` would copy the whole block for every column
+        data = _encode(df[(block, column)].rename(column))
+        md5.update(repr((block, column)).encode() + data)
+        storage.Path(f'{root}/{block}/{column}').write_bytes(data, codec=codec)
+    index = pickle.dumps(df.index)
+    md5.update(index)
+    # The index goes last, so a store that was interrupted halfway through doesn't look complete
+    meta = {'columns': df.columns, 'index': df.index, 'digest': md5.hexdigest()}
+    storage.Path(f'{root}/index').write_bytes(pickle.dumps(meta))
+
+def exists(root):
+    return storage.Path(f'{root}/index').exists()
+
+def _projection(available, columns):
+    """`columns` can contain (block, column) tuples or whole block names"""
+    if columns is None:
+        return available
+    tuples = []
+    for c in columns:
+        if isinstance(c, str):
+            tuples.extend(t for t in available if t[0] == c)
+        elif c in available:
+            tuples.append(tuple(c))
+        else:
+            raise KeyError(f'{c} is not in the catalog')
+    return pd.MultiIndex.from_tuples(tuples)
+
+class Catalog(object):
+
+    def __init__(self, root, columns=None, _meta=None, _cache=None, _rows=None):
+        if _meta is None:
+            raw = storage.Path(f'{root}/index').read_bytes()
+            meta = pickle.loads(raw)
+            # Stores written before the digest was recorded only have their index to go on
+            meta.setdefault('digest', hashlib.md5(raw).hexdigest())
+        else:
+            meta = _meta
+        self._root = root
+        self._meta = meta
+        self._cache = {} if _cache is None else _cache
+        self._rows = _rows
+        self.columns = _projection(meta['columns'], columns)
+        self.index = meta['index'] if _rows is None else meta['index'][_rows]
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def version(self):
+        """Identifies which rows of what data this catalog holds. Rebuilding the store with different data 
+        changes it, even if the rows and the root stay the same."""
+        rows = b'' if self._rows is None else self._rows.tobytes()
+        return hashlib.md5(self._meta['digest'].encode() + rows).hexdigest()
+
+    def _column(self, block, column):
+        if (block, column) not in self.columns:
+            raise KeyError(f'({block}, {column}) is not in the catalog')
+        if (block, column) not in self._cache:
+            log.debug(f'Loading {block}.{column}')
+            path = storage.Path(f'{self._root}/{block}/{column}')
+            self._cache[block, column] = _decode(path.read_bytes(), self._meta['index'], column)
+        series = self._cache[block, column]
+        return series if self._rows is None else series.iloc[self._rows]
+
+    def __getattr__(self, block):
+        if block.startswith('_') or block not in self.columns.get_level_values(0):
+            raise AttributeError(block)
+        return Block(self, block)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return Block(self, key)
+        if isinstance(key, tuple):
+            return self._column(*key)
+
+        # Anything else is a row selection, either a boolean mask or integer positions
+        key = sp.asarray(key)
+        positions = sp.flatnonzero(key) if key.dtype == bool else key
+        rows = positions if self._rows is None else self._rows[positions]
+        return type(self)(self._root, self.columns, self._meta, self._cache, rows)
+
+    def __getstate__(self):
+        # Don't drag the loaded columns along; they can be fetched again from storage
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        return state
+
+    def to_frame(self):
+        """Loads every column in the projection into a dataframe, like the one `store` was given"""
+        return pd.concat({b: Block(self, b).to_frame() for b in self.columns.get_level_values(0).unique()}, axis=1)
+
+    def __repr__(self):
+        return f'Catalog({self._root}, {len(self)} rows, {len(self.columns)} columns, {len(self._cache)} loaded)'
+
+class Block(object):
+    """One of the catalog's column blocks - `apogee`, `gaia`, `wise` or `tmass`"""
+
+    def __init__(self, catalog, block):
+        self._catalog = catalog
+        self._block = block
+
+    @property
+    def columns(self):
+        cols = self._catalog.columns
+        return pd.Index(cols.get_level_values(1)[cols.get_level_values(0) == self._block])
+
+    def __getattr__(self, column):
+        if column.startswith('_') or column not in self.columns:
+            raise AttributeError(column)
+        return self._catalog._column(self._block, column)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._catalog._column(self._block, key)
+        return pd.DataFrame({k: self._catalog._column(self._block, k) for k in key}, columns=list(key))
+
+    def to_frame(self):
+        return self[list(self.columns)]
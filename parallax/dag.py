@@ -0,0 +1,245 @@
+"""A small DAG runner with a content-addressed cache. Each stage declares the stages it takes as inputs and
+any parameters, and its output is stored under a hash of
+
+  * its name, parameters and code,
+  * the hashes of its inputs,
+  * for stages that manage their own cache, a fingerprint of the data they produced,
+
+so a stage's hash changes whenever anything upstream of it does. Re-running after a change recomputes the
+stale stages and loads the rest from the cache - or, if nothing downstream of a fresh stage is stale, doesn't
+even load it. Stages whose inputs are ready run concurrently on threads.
+
+    stages = [
+        Stage('catalog', data.load_catalog, cache=False),
+        Stage('parent', parent_sample, inputs=['catalog']),
+        Stage('spectra', data.load_spectra, inputs=['parent'], cache=False)]
+    results = run(stages)
+
+A stage's code is identified by the source of the module its function is defined in, along with every module
+of the same package that one imports, directly or not. That's coarser than it needs to be - editing any
+module `parallax.fit_training` reaches invalidates the model - but it means a change to a helper like `solve`
+is never missed. The package's `__init__` isn't followed, since it imports everything. If the behaviour of a
+stage changes in a way the source doesn't show - a new version of a dependency, say - bump its `version`.
+
+Stages with `cache=False` are always run, and what they return is fingerprinted, so new input data
+invalidates everything downstream of it. That means the hashes downstream of them aren't known until they've
+run, so `hashes` and `stale` run them too.
+"""
+import os
+import ast
+import sys
+import pickle
+import inspect
+import hashlib
+import logging
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from .aws import storage
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+__all__ = ('Stage', 'run')
+
+ROOT = 'alj.data/parallax/stages'
+
+class Stage(object):
+    """`f` gets called with the outputs of `inputs` as positional arguments and `params` as keyword arguments.
+    Stages that already cache their own output - like `data.load_spectra` - can pass `cache=False`, so they're
+    always run but still hashed, along with what they returned, for the sake of the stages downstream."""
+
+    def __init__(self, name, f, inputs=(), params={}, version=0, cache=True):
+        self.name = name
+        self.f = f
+        self.inputs = list(inputs)
+        self.params = dict(params)
+        self.version = version
+        self.cache = cache
+
+    def code(self):
+        module = getattr(self.f, '__module__', None) or ''
+        if _file(module) is not None:
+            return f'{_source(module)}\n{self.version}'
+        try:
+            source = inspect.getsource(self.f)
+        except (OSError, TypeError):
+            source = self.f.__code__.co_code.hex()
+        return f'{source}\n{self.version}'
+
+    def __repr__(self):
+        return f'Stage({self.name}, inputs={self.inputs})'
+
+def _file(name):
+    """The source file of the module `name`, found without importing it, or None if it isn't one"""
+    package, *parts = name.split('.')
+    if getattr(sys.modules.get(package), '__file__', None) is None:
+        return None
+    root = os.path.dirname(sys.modules[package].__file__)
+    base = os.path.join(root, *parts)
+    for path in (base + '.py', os.path.join(base, '__init__.py')):
+        if os.path.isfile(path):
+            return path
+    return None
+
+def _imports(name):
+    """The modules of `name`'s package that the module `name` imports anywhere in its source, including
+    inside functions"""
+    path = _file(name)
+    package = name.split('.')[0]
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    # What relative imports in this module are relative to
+    parent = name if path.endswith('__init__.py') else name.rpartition('.')[0]
+
+    found = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            found.update(a.name for a in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = importlib.util.resolve_name('.'*node.level + (node.module or ''), parent) if node.level else node.module
+            # `from .tools import cut` depends on `tools`. `from . import tools` does too, but not on the
+            # package's `__init__` - which imports every module, so would tie every stage to all of them.
+            if node.module:
+                found.add(base)
+            # Names that aren't modules, like `cut`, get filtered out below
+            found.update(f'{base}.{a.name}' for a in node.names)
+    found = {f for f in found if f.split('.')[0] == package and f != name}
+    return {f for f in found if _file(f) is not None}
+
+def _source(name):
+    """A hash of the source of the module `name` and of every module in its package that it imports, 
+    transitively. It's read afresh every time, so edits made during a session aren't missed."""
+    seen, queue = set(), [name]
+    while queue:
+        m = queue.pop()
+        if m not in seen:
+            seen.add(m)
+            queue.extend(_imports(m))
+    md5 = hashlib.md5()
+    for m in sorted(seen):
+        with open(_file(m), 'rb') as f:
+            md5.update(f'# {m}\n'.encode() + f.read())
+    return md5.hexdigest()
+
+def fingerprint(output):
+    """Identifies the data a stage produced. Catalogs from the column store know which rows of which store
+    they are; frames are hashed by their index, column names and values; anything else by its pickle."""
+    if hasattr(output, 'version'):
+        return output.version
+    import pandas as pd
+    md5 = hashlib.md5()
+    if isinstance(output, (pd.DataFrame, pd.Series)):
+        columns = list(output.columns) if isinstance(output, pd.DataFrame) else output.name
+        md5.update(repr(columns).encode())
+        md5.update(pd.util.hash_pandas_object(output, index=True).values.tobytes())
+    else:
+        md5.update(pickle.dumps(output))
+    return md5.hexdigest()
+
+def _check(stages):
+    """Raises if there's a cycle or a missing input"""
+    stages = {s.name: s for s in stages}
+    done, visiting = set(), set()
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f'Stage "{name}" depends on itself')
+        if name not in stages:
+            raise KeyError(f'No stage named "{name}"')
+        visiting.add(name)
+        for i in stages[name].inputs:
+            visit(i)
+        visiting.discard(name)
+        done.add(name)
+
+    for name in stages:
+        visit(name)
+
+def _path(stage, digest):
+    return storage.Path(f'{ROOT}/{stage.name}/{digest}')
+
+class _Run(object):
+    """Works out hashes and outputs on demand, each at most once. Both are futures on a thread pool, since
+    the hash of a stage downstream of an uncached one has to wait for that one's output."""
+
+    def __init__(self, stages, pool, codec=None):
+        self.named = {s.name: s for s in stages}
+        self.pool, self.codec = pool, codec
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def _future(self, kind, name):
+        with self.lock:
+            if (kind, name) not in self.futures:
+                f = self._digest if kind == 'digest' else self._output
+                self.futures[kind, name] = self.pool.submit(f, name)
+            return self.futures[kind, name]
+
+    def digest(self, name):
+        return self._future('digest', name).result()
+
+    def output(self, name):
+        return self._future('output', name).result()
+
+    def _digest(self, name):
+        s = self.named[name]
+        # Submit all the inputs before waiting on any of them, so they run side-by-side
+        inputs = [self._future('digest', i) for i in s.inputs]
+        content = (s.name, s.code(), sorted(s.params.items()), [i.result() for i in inputs])
+        if not s.cache:
+            content += (fingerprint(self.output(name)),)
+        return hashlib.md5(repr(content).encode()).hexdigest()
+
+    def _output(self, name):
+        s = self.named[name]
+        if s.cache:
+            digest = self.digest(name)
+            path = _path(s, digest)
+            if path.exists():
+                log.info(f'Loading stage "{name}" from {digest}')
+                return pickle.loads(path.read_bytes())
+
+        inputs = [self._future('output', i) for i in s.inputs]
+        inputs = [i.result() for i in inputs]
+        log.info(f'Running stage "{name}"')
+        with metrics.stage(f'stage:{name}') as record:
+            if s.cache:
+                record['hash'] = digest
+            output = s.f(*inputs, **s.params)
+        if s.cache:
+            path.write_bytes(pickle.dumps(output), codec=self.codec)
+        return output
+
+def _pool(stages):
+    # Every hash and every output gets its own thread, since they block on each other's futures. There are
+    # only ever a handful of stages, so that's no hardship.
+    return ThreadPoolExecutor(max(2*len(stages), 1))
+
+def hashes(stages):
+    """Hashes every stage, upstream first. Raises if there's a cycle or a missing input. Any uncached stages
+    get run, since the hashes downstream of them depend on what they return."""
+    _check(stages)
+    with _pool(stages) as pool:
+        r = _Run(stages, pool)
+        return {s.name: r.digest(s.name) for s in stages}
+
+def stale(stages):
+    """The names of the stages that would be recomputed by `run`. Like `hashes`, this runs the uncached
+    stages - which are always recomputed anyway."""
+    digests = hashes(stages)
+    return [s.name for s in stages if not (s.cache and _path(s, digests[s.name]).exists())]
+
+def run(stages, targets=None, codec=None):
+    """Runs whatever's needed to produce `targets` - by default, every stage that nothing else depends on -
+    and returns a dict of their outputs."""
+    _check(stages)
+    if targets is None:
+        consumed = {i for s in stages for i in s.inputs}
+        targets = [s.name for s in stages if s.name not in consumed]
+
+    with _pool(stages) as pool:
+        r = _Run(stages, pool, codec)
+        futures = [r._future('output', t) for t in targets]
+        return {t: f.result() for t, f in zip(targets, futures)}
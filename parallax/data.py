@@ -1,28 +1,36 @@
-import requests
 from io import BytesIO
 import tempfile
 import scipy as sp
-import astropy
-import astropy.table
+from numpy.random import RandomState
 import os
-from .aws import s3
+from pathlib import Path
+from .aws import storage, codecs
 import logging
 import time
 import pandas as pd
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor, as_completed
 import pickle
+import hashlib
+from . import tools, metrics
+from . import catalog as catalogs
 
 log = logging.getLogger(__name__)
 
 PATH = 'alj.data/parallax/apogee_gaia.fits'
+COLUMNS = 'alj.data/parallax/apogee_gaia'
+NORMED = 'alj.data/parallax/normed'
+# zstd's an optional dependency, so the caches are written uncompressed when it isn't installed
+CODEC = 'zstd' if codecs.available('zstd') else None
 
 APRED_VERS = 'r8'
 ASPCAP_VER = 'l31c'
 RESULTS_VER = 'l31c.2'
 
-def drop_multidim_cols(table):
-    return table[[k for k, (d, _) in table.dtype.fields.items() if d.shape == ()]]
+# The allStar file has a couple hundred columns, but these are the only ones anything downstream uses. 
+APOGEE_COLUMNS = [
+    'apogee_id', 'telescope', 'location_id', 'file', 'ra', 'dec',
+    'j', 'j_err', 'h', 'h_err', 'k', 'k_err',
+    'teff', 'logg', 'm_h', 'alpha_m', 'vhelio_avg', 'snr', 'aspcapflag', 'starflag']
 
 def stringify(df):
     # None of the bytestrings in these tables actually look like they should be bytestrings.
@@ -35,60 +43,142 @@ def stringify(df):
 
     return df
 
-def fetch_apogee():
-    """APOGEE DR14 info: https://www.sdss.org/dr14/irspec/spectro_data/"""
-
-    url = f'https://data.sdss.org/sas/dr14/apogee/spectro/redux/{APRED_VERS}/stars/{ASPCAP_VER}/{RESULTS_VER}/allStar-{RESULTS_VER}.fits'
-    r = requests.get(url)
-    table = astropy.table.Table.read(BytesIO(r.content), hdu=1)
-    table = drop_multidim_cols(table)
+def download(url, path, chunk_size=2**20):
+    """Streams `url` to the local file `path`, so the whole file never has to sit in memory. The download 
+    goes to a temporary file first, so an interrupted download won't be mistaken for a finished one."""
+    import requests
+    path = Path(path)
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp = path.with_name(path.name + '.tmp')
+    with requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        total = int(r.headers.get('content-length', 0)) or None
+        with open(tmp, 'wb') as f, tqdm(total=total, unit='B', unit_scale=True) as pbar:
+            for chunk in r.iter_content(chunk_size):
+                f.write(chunk)
+                pbar.update(len(chunk))
+    tmp.replace(path)
+    return path
+
+def fits_columns(path, columns=None, hdu=1):
+    """Reads `columns` out of a FITS table without loading the rest of it. The file's memmapped, so only
+    the requested columns are ever read off the disk. If `columns` is None, all the scalar columns are read.
+
+    Bytestring columns are decoded in one go by numpy rather than element-by-element by pandas."""
+    import astropy.io.fits
+    with astropy.io.fits.open(path, memmap=True) as hdus:
+        data = hdus[hdu].data
+        names = {n.lower(): n for n in data.names}
+        if columns is None:
+            columns = [c for c, n in names.items() if data.field(n).ndim == 1]
+
+        result = {}
+        for c in columns:
+            values = data.field(names[c])
+            if values.dtype.kind == 'S':
+                values = values.astype(str)
+            else:
+                # FITS is big-endian, which pandas doesn't much like
+                values = values.astype(values.dtype.newbyteorder('='))
+            result[c] = values
+
+    return pd.DataFrame(result, columns=columns)
+
+@metrics.timed(items=len)
+def fetch_apogee(columns=APOGEE_COLUMNS):
+    """APOGEE DR14 info: https://www.sdss.org/dr14/irspec/spectro_data/
     
-    return (table
-                    .to_pandas()
-                    .rename(columns=str.lower)
-                    .pipe(stringify))
-
-def fetch_gaia(tmass_ids):
-    from astroquery.gaia import Gaia
-
-    # Can't prefix columns with the table name, so have to settle on using 'panda_start' and 
-    # 'wise_start'
-    query = """
-        select
-            mine.tmass_id as tmass_id,
-            '' as gaia_start,
-            gaia.*, 
-            '' as wise_start,
-            allwise.*
-        from gaiadr2.gaia_source as gaia
-
-            inner join gaiadr2.tmass_best_neighbour as tmass_xmatch
-                on gaia.source_id = tmass_xmatch.source_id
-            inner join tap_upload.mine as mine 
-                on tmass_xmatch.original_ext_source_id = mine.tmass_id
-
-            inner join gaiadr2.allwise_best_neighbour as allwise_xmatch
-                on gaia.source_id = allwise_xmatch.source_id
-            inner join gaiadr1.allwise_original_valid as allwise
-                on allwise_xmatch.original_ext_source_id = allwise.designation"""
+    Pass `columns=None` to get every scalar column, as this used to do."""
 
+    url = f'https://data.sdss.org/sas/dr14/apogee/spectro/redux/{APRED_VERS}/stars/{ASPCAP_VER}/{RESULTS_VER}/allStar-{RESULTS_VER}.fits'
+    path = download(url, f'cache/allStar-{RESULTS_VER}.fits')
+    return fits_columns(path, columns)
+
+# Can't prefix columns with the table name, so have to settle on using 'panda_start' and 
+# 'wise_start'
+GAIA_QUERY = """
+    select
+        mine.tmass_id as tmass_id,
+        '' as gaia_start,
+        gaia.*, 
+        '' as wise_start,
+        allwise.*
+    from gaiadr2.gaia_source as gaia
+
+        inner join gaiadr2.tmass_best_neighbour as tmass_xmatch
+            on gaia.source_id = tmass_xmatch.source_id
+        inner join tap_upload.mine as mine 
+            on tmass_xmatch.original_ext_source_id = mine.tmass_id
+
+        inner join gaiadr2.allwise_best_neighbour as allwise_xmatch
+            on gaia.source_id = allwise_xmatch.source_id
+        inner join gaiadr1.allwise_original_valid as allwise
+            on allwise_xmatch.original_ext_source_id = allwise.designation"""
+
+GAIA_CHUNKS = 'alj.data/parallax/gaia'
+
+def gaia_job(tmass_ids, tap, poll=5):
+    """Runs the cross-match for one batch of IDs. `tap` is anything with astroquery's `launch_job_async` 
+    interface - usually `astroquery.gaia.Gaia`, but a fake works just as well for testing."""
+    import astropy.table
     with tempfile.NamedTemporaryFile(suffix='.xml') as tmp:
         os.remove(tmp.name) # astropy will complain if the file already exists
         (astropy.table.Table(tmass_ids[:, None].astype(bytes), names=['tmass_id'])
             .write(tmp.name, format='votable'))
 
         log.info(f'Launching job for {len(tmass_ids)} 2MASS IDs')
-        job = Gaia.launch_job_async(query, upload_resource=tmp.name, upload_table_name='mine')
+        job = tap.launch_job_async(GAIA_QUERY, upload_resource=tmp.name, upload_table_name='mine')
         log.info(f'Job ID is {job.get_jobid()}')
 
     while True:
-        time.sleep(5)
-        log.info(f'Job is {job.get_phase()}')
-        if job.get_phase() == 'COMPLETED':
-            table = job.get_results()
+        phase = job.get_phase()
+        log.info(f'Job {job.get_jobid()} is {phase}')
+        if phase == 'COMPLETED':
+            return job.get_results().to_pandas().pipe(stringify)
+        if phase in ('ERROR', 'ABORTED'):
+            raise IOError(f'Job {job.get_jobid()} finished with phase {phase}')
+        time.sleep(poll)
+
+def gaia_chunk(tmass_ids, tap, retries=2, poll=5):
+    """Cross-matches one chunk, caching the result under a hash of its IDs. If the cache is already there - 
+    say because a previous run died halfway through - the job is skipped entirely."""
+    digest = hashlib.md5('\n'.join(tmass_ids).encode()).hexdigest()
+    path = storage.Path(f'{GAIA_CHUNKS}/{digest}')
+    if path.exists():
+        return pickle.loads(path.read_bytes())
+
+    for attempt in range(retries + 1):
+        try:
+            df = gaia_job(tmass_ids, tap, poll)
             break
+        except Exception:
+            if attempt == retries:
+                raise
+            log.exception(f'Job for chunk {digest} failed, retrying')
+
+    path.write_bytes(pickle.dumps(df), codec=CODEC)
+    return df
 
-    df = table.to_pandas().pipe(stringify)
+@metrics.timed(items=len)
+def fetch_gaia(tmass_ids, chunk_size=25000, N=4, tap=None, poll=5):
+    """Cross-matches the 2MASS IDs against Gaia and WISE. The IDs are split into chunks that are submitted 
+    as `N` concurrent jobs, and each chunk's results are cached as soon as they arrive. Re-running after a 
+    failure will only resubmit the chunks that didn't finish.
+    
+    With no IDs, nothing is submitted and the result is an empty frame with just the 2MASS ID column, since
+    the Gaia and WISE columns aren't known until a query's been run."""
+    tmass_ids = sp.sort(sp.unique(tmass_ids)) # Sorted so the chunks - and their caches - are stable
+    if len(tmass_ids) == 0:
+        df = pd.DataFrame(columns=['tmass_id', 'gaia_start', 'wise_start'])
+    else:
+        if tap is None:
+            from astroquery.gaia import Gaia as tap
+        chunks = [tmass_ids[i:i+chunk_size] for i in range(0, len(tmass_ids), chunk_size)]
+        with tools.parallel(gaia_chunk, N=N, processes=False) as p:
+            df = pd.concat(p.wait(p(c, tap, poll=poll) for c in chunks), ignore_index=True)
 
     gaia_start = list(df.columns).index('gaia_start')
     wise_start = list(df.columns).index('wise_start')
@@ -96,7 +186,7 @@ def fetch_gaia(tmass_ids):
     masks = {'tmass': df.columns == 'tmass_id',
              'gaia': (gaia_start < indices) & (indices < wise_start),
              'wise': (wise_start < indices)}
-    df = pd.concat({k: df.loc[:, m] for k, m in masks.items()}, 1)
+    df = pd.concat({k: df.loc[:, m] for k, m in masks.items()}, axis=1)
 
     # Some fields have a _2 suffixed because they're replicated in GAIA and WISE
     df = df.rename(columns=lambda c: c.split('_2')[0])
@@ -118,18 +208,27 @@ def fetch_catalog():
     catalog = pd.merge(apogee, gaia, left_on=(('apogee', 'tmass_id'),), right_on=(('tmass', 'tmass_id'),))
     return catalog
 
-def load_catalog():
-    path = s3.Path(PATH)
-    if not path.exists():
-        log.info('No apogee-gaia cache available, creating it from scratch')
-        catalog = fetch_catalog()
-        path.write_bytes(pickle.dumps(catalog))
+@metrics.timed(items=len)
+def load_catalog(columns=None):
+    """Returns a lazily-loaded `catalog.Catalog`. Columns are only fetched when they're first used, or pass 
+    `columns=` - a list of (block, column) tuples or block names - to fix the projection up front."""
+    if not catalogs.exists(COLUMNS):
+        path = storage.Path(PATH)
+        if path.exists():
+            log.info('Splitting the old apogee-gaia cache into columns')
+            df = pickle.loads(path.read_bytes())
+        else:
+            log.info('No apogee-gaia cache available, creating it from scratch')
+            df = fetch_catalog()
+        catalogs.store(df, COLUMNS, codec=CODEC)
         time.sleep(1) # Going straight to reading can time out sometimes
 
-    return pickle.loads(path.read_bytes())
+    return catalogs.Catalog(COLUMNS, columns)
 
 def fetch_spectrum(telescope, location_id, file):
     """Data model: https://data.sdss.org/datamodel/files/APOGEE_REDUX/APRED_VERS/APSTAR_VERS/TELESCOPE/LOCATION_ID/apStar.html#hdu1"""
+    import requests
+    import astropy.io.fits
 
     url = f'https://data.sdss.org/sas/dr14/apogee/spectro/redux/{APRED_VERS}/stars/{telescope.strip()}/{location_id}/{file.strip()}'
     r = requests.get(url)
@@ -162,7 +261,7 @@ def downsample(spectra):
     return pd.concat(result, 1) if result else spectra
 
 def load_spectrum_group(telescope, location_id, files):
-    path = s3.Path(f'alj.data/parallax/spectra/{telescope}/{location_id}')
+    path = storage.Path(f'alj.data/parallax/spectra/{telescope}/{location_id}')
     if not path.exists():
         spectra = {}
         for file in files:
@@ -176,24 +275,32 @@ def load_spectrum_group(telescope, location_id, files):
         else:
             spectra = pd.DataFrame(columns=pd.MultiIndex.from_arrays([[], []]))
 
-        path.write_bytes(pickle.dumps(spectra))
+        path.write_bytes(pickle.dumps(spectra), codec=CODEC)
         return spectra
 
     spectra = pd.read_pickle(BytesIO(path.read_bytes())).pipe(downsample)
     return spectra
 
+@metrics.timed(items=len)
 def load_spectra(catalog):
     log.warn('If the cuts change, the spectra will not be updated')
     #TODO: Handle changing cuts/file lists. Need to make note of missing files
     #TODO: Move away from pickling - will break when pandas changes
-    #TODO: Restore parallelism. Kept hitting broken process pool errors, despite everything working fine in serial?
-    path = s3.Path(f'alj.data/parallax/spectra/parent')
+    path = storage.Path(f'alj.data/parallax/spectra/parent')
     if not path.exists():
-        spectra = []
-        for (telescope, location_id), files in tqdm(catalog.apogee.groupby(['telescope', 'location_id']).file):
-            spectra.append(load_spectrum_group(telescope.strip(), location_id, list(files)))
-        spectra = pd.concat(spectra)        
-        path.write_bytes(pickle.dumps(spectra))
+        groups = catalog.apogee[['telescope', 'location_id', 'file']].groupby(['telescope', 'location_id']).file
+        # The pool used to break partway through fetching, so failures are recorded rather than raised
+        with tools.parallel(load_spectrum_group, errors='record') as p:
+            spectra = p.wait({(t.strip(), l): p(t.strip(), l, list(fs)) for (t, l), fs in groups})
+            failures = dict(p.failures)
+        if not spectra:
+            raise IOError(f'Failed to load all {len(failures)} spectrum groups: {failures}')
+        spectra = pd.concat([spectra[k] for k in sorted(spectra)])
+
+        if failures:
+            log.warning(f'Failed to load {len(failures)} spectrum groups, so not caching the parent sample: {list(failures)}')
+        else:
+            path.write_bytes(pickle.dumps(spectra), codec=CODEC)
         return spectra
     
     spectra = pd.read_pickle(BytesIO(path.read_bytes()))
@@ -201,4 +308,59 @@ def load_spectra(catalog):
     missing = set(expected) - set(spectra.index)
     log.warn(f'Missing spectra for {len(missing)} stars out of {len(catalog)}')
 
-    return spectra.reindex(index=expected)
\ No newline at end of file
+    return spectra.reindex(index=expected)
+
+@metrics.timed(items=len)
+def store_spectra(normed, root=NORMED):
+    """Stores normalized spectra pixel-major - each pixel's flux and error as its own column - and returns
+    them as a lazily-loaded `catalog.Catalog`. `parallax.predict` then only fetches the pixels the model
+    actually uses.
+    
+    The store goes under a hash of the spectra, so different spectra never pick up each other's store and
+    the same spectra are only ever stored once."""
+    root = f'{root}/{tools.version(normed)}'
+    if not catalogs.exists(root):
+        catalogs.store(normed, root, codec=CODEC)
+    return catalogs.Catalog(root)
+
+def synthetic_spectra(n_stars=1000, n_pixels=7514, bad=.05, seed=20181111):
+    """Normalized-looking spectra for benchmarking: flux scattered around 1 and errors mostly small, 
+    but with a fraction of the pixels set to `ERROR_LIM` as `specnorm` does for unreliable ones."""
+    from .specnorm import ERROR_LIM
+    rs = RandomState(seed)
+    wavelengths = sp.around(sp.linspace(15150, 16950, n_pixels), 2)
+    flux = sp.clip(1 + .02*rs.standard_normal((n_stars, n_pixels)), 0, 1.2).astype(sp.float32)
+    error = sp.fabs(.01*rs.standard_normal((n_stars, n_pixels))).astype(sp.float32)
+    unreliable = rs.random_sample((n_stars, n_pixels)) < bad
+    flux[unreliable] = 1
+    error[unreliable] = ERROR_LIM
+    return pd.concat({
+        'flux': pd.DataFrame(flux, columns=wavelengths), 
+        'error': pd.DataFrame(error, columns=wavelengths)}, axis=1)
+
+def benchmark_codecs(spectra=None, levels={'zstd': [1, 3, 9], 'lz4': [0, 3]}, bandwidth=100, repeats=3):
+    """Compares the size, CPU time and transfer time of storing pickled spectra with each codec.
+    Transfer time is estimated from `bandwidth`, in MB/s; ~100MB/s is typical for S3 from EC2."""
+    spectra = synthetic_spectra() if spectra is None else spectra
+    raw = pickle.dumps(spectra)
+
+    def timed(f, *args):
+        times = []
+        for _ in range(repeats):
+            start = time.process_time()
+            result = f(*args)
+            times.append(time.process_time() - start)
+        return result, min(times)
+
+    results = {('none', 0): {'size': len(raw), 'compress': 0., 'decompress': 0.}}
+    for codec, ls in levels.items():
+        for level in ls:
+            compressed, compress_time = timed(codecs.compress, raw, codec, level)
+            _, decompress_time = timed(codecs.decompress, compressed, codec)
+            results[codec, level] = {'size': len(compressed), 'compress': compress_time, 'decompress': decompress_time}
+
+    results = pd.DataFrame.from_dict(results, orient='index')
+    results['ratio'] = len(raw)/results['size']
+    results['transfer'] = results['size']/(bandwidth*2**20)
+    results['round_trip'] = results[['compress', 'transfer', 'decompress']].sum(1)
+    return results
@@ -0,0 +1,127 @@
+"""Galactocentric coordinates for the whole catalog at once, with Monte Carlo uncertainties.
+
+This does the same transform as astropy's `ICRS` -> `Galactocentric`, but with the rotation matrices written
+out by hand so that it's a couple of matrix products over arrays of any shape, rather than a frame object per
+star. That makes it cheap enough to push every star's samples through in one go:
+
+    mean_cart, cov_cart, mean_cyl, cov_cyl = sample(
+        ra, dec, parallax, parallax_err, pmra, pmra_err, pmdec, pmdec_err, rv)
+
+Stars are processed in blocks of `block`, so memory stays at `block * n_samples` rows however big the
+catalog is. Units are degrees, mas, mas/yr, km/s in, and kpc, km/s out.
+"""
+import logging
+import scipy as sp
+from numpy.random import RandomState
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+# Galactocentric position of the Sun (Gravity collaboration 2018; Juric et al. 2008)
+X_SUN = 8.122 # kpc
+Z_SUN = 0.025 # kpc
+
+# Galactocentric velocity of the Sun (Schoenrich et al. 2009, with Sgr A* from Reid & Brunnthaler 2004).
+# The sign of `vX` is flipped, as it was in the original scripts.
+V_SUN = (11.1, 245.8, 7.8) # km/s
+
+# Where astropy puts Sgr A*, and the roll that makes the galactic north pole point along +z
+GALCEN_RA = 266.4051
+GALCEN_DEC = -28.936175
+ROLL0 = 58.5986320306
+
+# km/s per (mas/yr * kpc)
+K = 4.740470463533348
+
+# Floor on the APOGEE radial velocity errors
+RV_FLOOR = 0.1 # km/s
+
+def _rotation(angle, axis):
+    """Rotates the axes - not the vectors - by `angle` degrees about `axis`, as astropy's `rotation_matrix` does"""
+    c, s = sp.cos(sp.radians(angle)), sp.sin(sp.radians(angle))
+    i, j = [(1, 2), (2, 0), (0, 1)]['xyz'.index(axis)]
+    R = sp.eye(3)
+    R[i, i], R[i, j], R[j, i], R[j, j] = c, s, -s, c
+    return R
+
+def matrices(distance=X_SUN, z=Z_SUN):
+    """The rotation `A` and offset `b` that take heliocentric ICRS positions to galactocentric ones, `A@x + b`.
+    Velocities just need rotating by `A` and adding `V_SUN`."""
+    R = _rotation(ROLL0, 'x') @ _rotation(-GALCEN_DEC, 'y') @ _rotation(GALCEN_RA, 'z')
+    # Tilts the plane so the Sun sits `z` above it
+    H = _rotation(-sp.degrees(sp.arcsin(z/distance)), 'y')
+    return H @ R, -H @ sp.array([distance, 0., 0.])
+
+def heliocentric(ra, dec, parallax, pmra, pmdec, rv):
+    """ICRS positions in kpc and velocities in km/s, each as a `(..., 3)` array. `pmra` includes the
+    cos(dec) factor, as it does in Gaia. Non-positive parallaxes give NaNs."""
+    ra, dec = sp.radians(sp.asarray(ra, dtype=float)), sp.radians(sp.asarray(dec, dtype=float))
+    parallax = sp.asarray(parallax, dtype=float)
+    distance = sp.where(parallax > 0, 1/sp.where(parallax > 0, parallax, 1), sp.nan)
+
+    cos_ra, sin_ra, cos_dec, sin_dec = sp.cos(ra), sp.sin(ra), sp.cos(dec), sp.sin(dec)
+    zero = sp.zeros_like(ra)
+    r = sp.stack([cos_dec*cos_ra, cos_dec*sin_ra, sin_dec], -1)
+    e_ra = sp.stack([-sin_ra, cos_ra, zero], -1)
+    e_dec = sp.stack([-sin_dec*cos_ra, -sin_dec*sin_ra, cos_dec], -1)
+
+    tangential = K*distance[..., None]*(sp.asarray(pmra)[..., None]*e_ra + sp.asarray(pmdec)[..., None]*e_dec)
+    return distance[..., None]*r, sp.asarray(rv)[..., None]*r + tangential
+
+def cartesian(ra, dec, parallax, pmra, pmdec, rv, distance=X_SUN, z=Z_SUN, v_sun=V_SUN):
+    """Galactocentric `(x, y, z, vx, vy, vz)` as a `(..., 6)` array"""
+    A, b = matrices(distance, z)
+    x, v = heliocentric(ra, dec, parallax, pmra, pmdec, rv)
+    return sp.concatenate([x @ A.T + b, v @ A.T + sp.asarray(v_sun)], -1)
+
+def cylindrical(cart):
+    """Converts `cartesian` output to `(rho, phi, z, v_rho, v_phi, v_z)`, with `phi` in radians"""
+    x, y, z, vx, vy, vz = sp.moveaxis(cart, -1, 0)
+    rho = sp.hypot(x, y)
+    return sp.stack([rho, sp.arctan2(y, x), z, (x*vx + y*vy)/rho, (x*vy - y*vx)/rho, vz], -1)
+
+def _moments(samples):
+    """Per-star means of `(n, n_samples, 6)` samples, plus the covariances of the velocities. Samples that
+    came out NaN are left out of both."""
+    finite = sp.isfinite(samples).all(-1)
+    n = finite.sum(1)
+    filled = sp.where(finite[..., None], samples, 0)
+    mean = filled.sum(1)/n[:, None]
+    dv = sp.where(finite[..., None], samples[..., 3:] - mean[:, None, 3:], 0)
+    cov = (sp.swapaxes(dv, 1, 2) @ dv)/(n - 1)[:, None, None]
+    return mean, cov
+
+@metrics.timed(items=lambda r: len(r[0]))
+def sample(ra, dec, parallax, parallax_err, pmra, pmra_err, pmdec, pmdec_err, rv, rv_err=RV_FLOOR,
+           n_samples=256, block=4096, seed=42, **kwargs):
+    """Draws `n_samples` of each star's parallax, proper motion and radial velocity from Gaussians, and
+    pushes them through `cartesian`. Returns the per-star mean and velocity covariance of the samples, in
+    both Cartesian and cylindrical coordinates:
+
+      * `mean_cart`, `mean_cyl` are `(n, 6)`
+      * `cov_cart`, `cov_cyl` are `(n, 3, 3)`, over `(vx, vy, vz)` and `(v_rho, v_phi, v_z)` respectively
+
+    Don't average the mean `phi`s of several stars - it wraps. Any extra `kwargs` are passed to `cartesian`.
+    """
+    columns = [ra, dec, parallax, parallax_err, pmra, pmra_err, pmdec, pmdec_err, rv]
+    columns = [sp.asarray(c, dtype=float) for c in columns]
+    rv_err = sp.broadcast_to(sp.asarray(rv_err, dtype=float), columns[0].shape)
+    n = len(columns[0])
+
+    rs = RandomState(seed)
+    mean_cart, cov_cart = sp.full((n, 6), sp.nan), sp.full((n, 3, 3), sp.nan)
+    mean_cyl, cov_cyl = sp.full((n, 6), sp.nan), sp.full((n, 3, 3), sp.nan)
+    for start in range(0, n, block):
+        s = slice(start, start+block)
+        ra, dec, parallax, parallax_err, pmra, pmra_err, pmdec, pmdec_err, rv = [c[s, None] for c in columns]
+        size = (len(ra), n_samples)
+        draws = [rs.normal(parallax, parallax_err, size),
+                 rs.normal(pmra, pmra_err, size),
+                 rs.normal(pmdec, pmdec_err, size),
+                 rs.normal(rv, rv_err[s, None], size)]
+
+        cart = cartesian(ra, dec, *draws, **kwargs)
+        mean_cart[s], cov_cart[s] = _moments(cart)
+        mean_cyl[s], cov_cyl[s] = _moments(cylindrical(cart))
+        log.debug(f'Sampled {min(start+block, n)}/{n} stars')
+    return mean_cart, cov_cart, mean_cyl, cov_cyl
@@ -0,0 +1,112 @@
+"""Lightweight instrumentation for the pipeline stages. Wrap a stage with
+
+    with metrics.stage('normalize') as m:
+        normed = specnorm.normalize(spectra)
+        m['items'] = len(normed)
+
+or decorate it with `@metrics.timed(items=len)`, and its wall time, CPU time, peak RSS, storage traffic and
+throughput get appended as a JSON line to `PATH`. Every line carries the run's ID, so runs can be loaded
+with `pd.read_json(PATH, lines=True)` and compared with a groupby.
+
+Nothing's written unless you ask for it, by setting the `PARALLAX_METRICS` environment variable to the file to
+append to - or `PATH` itself, on this process. Workers inherit the environment variable, so it's the way to
+go if you want their stages recorded too. A record that can't be written only gets a warning; it never 
+breaks the code being measured.
+
+CPU time includes any worker processes that finished during the stage, and storage traffic includes any 
+tasks that `tools.parallel` ran on worker processes. Peak RSS is the high-water mark of
+this process so far, which is what matters for whether a run fits on an instance; `rss_growth` is how much
+this stage pushed it up by.
+"""
+import os
+import json
+import time
+import logging
+import threading
+import resource
+import functools
+from contextlib import contextmanager
+from . import aws
+
+log = logging.getLogger(__name__)
+
+PATH = os.environ.get('PARALLAX_METRICS') or None
+RUN = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}'
+
+# Stages can run on several threads at once, so each thread keeps its own stack of the stages it's inside
+_local = threading.local()
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _peak_rss():
+    # Linux reports in KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def _cpu():
+    self, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self.ru_utime + self.ru_stime + children.ru_utime + children.ru_stime
+
+def write(record, path=None):
+    path = PATH if path is None else path
+    if path is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+    except Exception as e:
+        log.warning(f'Couldn\'t write metrics to {path}: {e}')
+
+@contextmanager
+def stage(name, path=None):
+    """Records the metrics of the code in the block. The yielded dict can be used to add extra fields;
+    setting `items` also gets you a throughput."""
+    stack = _stack()
+    record = {'run': RUN, 'stage': name, 'parent': stack[-1] if stack else None}
+    start_wall, start_cpu, start_rss = time.time(), _cpu(), _peak_rss()
+    start_read, start_written = aws.BYTES['read'], aws.BYTES['written']
+
+    stack.append(name)
+    try:
+        yield record
+    finally:
+        stack.pop()
+        wall = time.time() - start_wall
+        record.update({
+            'start': start_wall,
+            'wall': wall,
+            'cpu': _cpu() - start_cpu,
+            'peak_rss': _peak_rss(),
+            'rss_growth': _peak_rss() - start_rss,
+            'bytes_read': aws.BYTES['read'] - start_read,
+            'bytes_written': aws.BYTES['written'] - start_written})
+        if record.get('items') is not None:
+            record['throughput'] = record['items']/max(wall, 1e-9)
+
+        log.info(f'{name} took {wall:.1f}s wall, {record["cpu"]:.1f}s CPU, peak RSS {record["peak_rss"]/2**30:.1f}GB')
+        write(record, path)
+
+def timed(name=None, items=None):
+    """Decorator version of `stage`. `items` is a function from the result to the number of items it
+    processed - often just `len`."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            with stage(f.__qualname__ if name is None else name) as record:
+                result = f(*args, **kwargs)
+                if items is not None:
+                    record['items'] = items(result)
+            return result
+        return wrapped
+    return decorator
+
+def import_time(module='parallax', repeats=5):
+    """How long a fresh interpreter takes to import `module`, in seconds. This is what every worker that
+    `tools.parallel` spawns pays before it can start on a task, so keep an eye on it."""
+    import sys
+    import subprocess
+    code = f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'
+    times = [float(subprocess.check_output([sys.executable, '-c', code])) for _ in range(repeats)]
+    return sorted(times)[len(times)//2]
@@ -1,8 +1,9 @@
 import pickle
 import pandas as pd
 import scipy as sp
-import scipy.optimize
-from . import tools, aws
+from numpy.random import RandomState
+from . import tools, metrics
+from .aws import storage
 import logging
 
 log = logging.getLogger(__name__)
@@ -12,18 +13,56 @@ TMASS_BANDS = ['j', 'h', 'k']
 WISE_BANDS = ['w1mpro', 'w2mpro']
 PARALLAX_OFFSET = 0.0483 #TODO: How much of a difference does this make?
 
-def design_matrix(catalog, normed):
-    constant = sp.ones((len(catalog), 1))
+# How many stars' spectra to gather at a time. Bounds the temporaries to a sliver of the design matrix.
+CHUNK = 4096
+
+def _rows(normed, catalog):
+    """The position of each star's spectrum in `normed`, or -1 if it hasn't got one. Computed once and used
+    to index straight into the spectra, rather than reindexing - and so copying - the whole table."""
+    return normed.index.get_indexer(catalog.apogee.file.str.strip())
+
+def _spectra(normed, rows, field, pixels, out):
+    """Writes the `field` - flux or error - of the spectra at `rows` into `out`, restricted to `pixels`. Stars 
+    without a spectrum get NaNs. `normed` can be a frame or a pixel-major `catalog.Catalog` from 
+    `data.store_spectra`, in which case only `pixels` are read."""
+    if isinstance(normed, pd.DataFrame):
+        positions = normed.columns.get_indexer([(field, p) for p in pixels])
+        if (positions < 0).any():
+            raise KeyError(f'{(positions < 0).sum()} of the pixels, like {pixels[sp.argmax(positions < 0)]}, have no {field}')
+        # A single column of a frame is a view of its block, whereas selecting a whole field copies it
+        column = lambda j: normed.iloc[:, positions[j]].values
+    else:
+        column = lambda j: normed[field, pixels[j]].values
+    for j in range(len(pixels)):
+        out[:, j] = column(j)[rows]
+    out[rows < 0] = sp.nan
+    return out
+
+def _photometry(columns, out):
+    i = 0
+    for c in columns:
+        c = c.values if hasattr(c, 'values') else c
+        out[:, i:i+c.shape[1]] = c
+        i += c.shape[1]
+    return out[:, i:]
+
+def _design_matrix(catalog, normed, pixels=None, rows=None):
     gaia = catalog.gaia[[f'phot_{b}_mean_mag' for b in GAIA_BANDS]]
     tmass = catalog.apogee[TMASS_BANDS]
     wise = catalog.wise[WISE_BANDS]
+    pixels = normed.flux.columns if pixels is None else pixels
 
-    aligned = normed.reindex(catalog.apogee.file.str.strip())
-    apogee = sp.log(sp.clip(aligned.flux.values, .01, 1.2)) #TODO: How much of an impact does this clipping have?
+    # Everything's written straight into `X`, so the peak memory is about one `X`
+    X = sp.empty((len(catalog), 1 + len(GAIA_BANDS) + len(TMASS_BANDS) + len(WISE_BANDS) + len(pixels)))
+    apogee = _photometry([sp.ones((len(catalog), 1)), gaia, tmass, wise], X)
+    rows = _rows(normed, catalog) if rows is None else rows
+    _spectra(normed, rows, 'flux', pixels, apogee)
+    sp.clip(apogee, .01, 1.2, out=apogee) #TODO: How much of an impact does this clipping have?
+    # The log's taken in place as `log1p(x - 1)`, since `sp.log` is the scimath version and has no `out`
+    apogee -= 1
+    sp.log1p(apogee, out=apogee)
 
-    X = sp.concatenate([constant, gaia.values, tmass.values, wise.values, apogee], 1)
-
-    cols = [('constant', ['constant']), ('gaia', gaia.columns), ('tmass', tmass.columns), ('wise', wise.columns), ('apogee', normed.flux.columns)]
+    cols = [('constant', ['constant']), ('gaia', gaia.columns), ('tmass', tmass.columns), ('wise', wise.columns), ('apogee', pixels)]
     cols = pd.MultiIndex.from_tuples([(d, c) for d, cs in cols for c in cs])
 
     m = sp.zeros(len(cols))
@@ -31,30 +70,113 @@ def design_matrix(catalog, normed):
 
     return X, m, cols
 
+@metrics.timed(items=lambda r: len(r[0]))
+def design_matrix(catalog, normed):
+    return _design_matrix(catalog, normed)
+
+@metrics.timed(items=lambda r: len(r[0]))
+def blocked_design_matrix(catalog, normed, path, block=10000):
+    """`design_matrix`, but built `block` stars at a time and written to `path` on local disk, for training 
+    sets too big to hold in memory. The matrix comes back as a `blocked.BlockedDesignMatrix`."""
+    from . import blocked
+    if len(catalog) == 0:
+        X, m, cols = _design_matrix(catalog, normed)
+        return blocked.write([X], path), m, cols
+
+    layout = {}
+    def blocks():
+        for i in range(0, len(catalog), block):
+            X, layout['m'], layout['cols'] = _design_matrix(tools.take(catalog, sp.arange(i, min(i+block, len(catalog)))), normed)
+            yield X
+    X = blocked.write(blocks(), path)
+    return X, layout['m'], layout['cols']
+
+def design_errors(catalog, normed, pixels=None, rows=None):
+    """The standard error of each entry of `design_matrix`, in the same layout. Gaia only gives flux errors, 
+    so those are converted to magnitude errors; the spectral errors are clipped the way the original did."""
+    gaia = catalog.gaia[[f'phot_{b}_mean_flux{s}' for b in GAIA_BANDS for s in ['', '_error']]].values
+    gaia = 1.09*gaia[:, 1::2]/gaia[:, 0::2]
+    tmass = catalog.apogee[[f'{b}_err' for b in TMASS_BANDS]]
+    wise = catalog.wise[[f'{b}_error' for b in WISE_BANDS]]
+    pixels = normed.flux.columns if pixels is None else pixels
+    rows = _rows(normed, catalog) if rows is None else rows
+
+    E = sp.empty((len(catalog), 1 + gaia.shape[1] + tmass.shape[1] + wise.shape[1] + len(pixels)))
+    apogee = _photometry([sp.zeros((len(catalog), 1)), gaia, tmass, wise], E)
+    _spectra(normed, rows, 'error', pixels, apogee)
+    #TODO: The .05 is a magic number from the original, and the errors do depend on it
+    sp.clip(apogee, 0, .05, out=apogee)
+    # The fluxes are only needed as a divisor, so they're fetched a chunk at a time rather than all at once
+    flux = sp.empty((min(CHUNK, len(rows)), len(pixels)))
+    for i in range(0, len(rows), CHUNK):
+        f = _spectra(normed, rows[i:i+CHUNK], 'flux', pixels, flux[:len(rows[i:i+CHUNK])])
+        apogee[i:i+CHUNK] /= sp.clip(f, .01, 1.2, out=f)
+
+    return E
+
 def check_grad(f, grad, b0, eps=1e-6, k=10):
     """The easiest way to check the gradient is with sp.optimize.check_grad, but that checks the grad 
     in every.single.coordinate, which takes forever. Fast way to do it is to pick a bunch of random 
     vectors instead"""
-    sp.random.seed(20181111)
+    rs = RandomState(20181111)
     for _ in range(k):
-        db = sp.random.normal(size=len(b0))
+        db = rs.normal(size=len(b0))
         db = eps*db/(db**2).sum()**.5
 
         df = f(b0 + db) - f(b0)
         dfhat = grad(b0) @ db
         assert abs(df - dfhat)/df < 1e-3, 'Change in `f` and gradient-implied change in `f` were substantially different'
 
-def solve(X, y, w, m, b0=None, lambd=30, check=False):
+# Each link is a function from the linear predictor `X @ b` to the prediction, along with its derivative
+LINKS = {
+    'exp': (sp.exp, sp.exp),
+    'identity': (lambda eta: eta, sp.ones_like)}
+
+def objective(X, y, w, l1=0., l2=0., eta2=0., link='exp'):
+    """The loss used by all the model variants, and its gradient:
+
+        .5*w @ (y - g(X@b))**2 + l1 @ |b| + l2 @ b**2 + eta2 * |X@b|**2
+
+    where `g` is the `link`. The parallax models are the `exp` link with L1 on the pixels; the RR Lyrae
+    variant adds `eta2`; the abundance and age models are the `identity` link. `l1` and `l2` can be
+    scalars or per-column weights.
+
+    `X` only needs to support `X @ b`, `v @ X` and `X.shape`, so it can be a `blocked.BlockedDesignMatrix`."""
+    g, dg = LINKS[link]
+
+    # The optimizer asks for the loss and the gradient at the same `b`, so hang on to the last `X @ b`
+    # rather than working it out twice. That's a whole pass over the data when `X` is on disk.
+    last = {}
+    def predictor(b):
+        if 'b' not in last or not sp.array_equal(last['b'], b):
+            last['b'], last['eta'] = sp.array(b), X @ b
+        return last['eta']
+
+    def f(b, *args):
+        eta = predictor(b)
+        yhat = g(eta)
+        return .5*w @ (y - yhat)**2 + sp.sum(l1*sp.fabs(b)) + sp.sum(l2*b**2) + eta2*eta @ eta
 
-    def f(b, *args):   
-        yhat = sp.exp(X @ b)
-        return .5*w @ (y - yhat)**2 + lambd*m @ sp.fabs(b)
-    
     def grad(b, *args):
-        yhat = sp.exp(X @ b)
+        eta = predictor(b)
+        yhat = g(eta)
         # Fun fact: if you do `X.T @ v` here instead of `v @ X`, it's x10 slower
-        return -(yhat * w * (y - yhat)) @ X + lambd*m*sp.sign(b)
-    
+        return (-dg(eta) * w * (y - yhat) + 2*eta2*eta) @ X + l1*sp.sign(b) + 2*l2*b
+
+    return f, grad
+
+@metrics.timed()
+def solve(X, y, w, m=None, b0=None, lambd=30, check=False, l1=None, **kwargs):
+    """Minimizes `objective`. The L1 weights are `lambd` on the columns flagged in `m` - the pixels, as 
+    `design_matrix` flags them - or on every column if there's no `m`. They can also be given explicitly as 
+    `l1`. Any other `kwargs` are passed to `objective`."""
+    import scipy.optimize
+
+    if l1 is None:
+        l1 = lambd if m is None else lambd*sp.asarray(m)
+    l1 = sp.broadcast_to(sp.asarray(l1, dtype=float), (X.shape[1],))
+    f, grad = objective(X, y, w, l1=l1, **kwargs)
+
     i = 0
     def callback(b):
         nonlocal i
@@ -62,7 +184,7 @@ def solve(X, y, w, m, b0=None, lambd=30, check=False):
         log.info(f'Step {i}: loss is {f(b):.1f}')
 
     #TODO: My instinct is that this should this be constant in l2 norm rather than l1?
-    b0 = sp.full(len(m), 1e-3/len(m)) if b0 is None else b0
+    b0 = sp.full(X.shape[1], 1e-3/X.shape[1]) if b0 is None else b0
 
     if check:
         check_grad(f, grad, b0)
@@ -82,39 +204,147 @@ def solve(X, y, w, m, b0=None, lambd=30, check=False):
     bstar = result.x
     return bstar
 
+def train(X, y, w, burnin=None, **kwargs):
+    """Solves on the `burnin` rows first, if given, then on all the rows starting from there. With the
+    `exp` link, starting from scratch on everything tends to wander off. `kwargs` go to `solve`."""
+    b0 = kwargs.pop('b0', None)
+    if burnin is not None:
+        b0 = solve(X[burnin], y[burnin], w[burnin], b0=b0, **kwargs)
+    return solve(X, y, w, b0=b0, **kwargs)
+
+def quadratic(X, cols, include):
+    """Appends the products of every pair of the columns in `include` - a boolean mask over `cols` -
+    including each column with itself. The new columns are named `('quadratic', 'a*b')`."""
+    idx = sp.flatnonzero(include)
+    i, j = sp.triu_indices(len(idx))
+    Q = X[:, idx[i]]*X[:, idx[j]]
+    names = [f'{cols[a][-1]}*{cols[b][-1]}' for a, b in zip(idx[i], idx[j])]
+    quad = pd.MultiIndex.from_tuples([('quadratic', n) for n in names])
+    return sp.concatenate([X, Q], 1), cols.append(quad)
+
+def folds(n, K=2, seed=20181111):
+    """Assigns each of `n` rows to one of `K` folds at random, like the `random_index % Kfold` of the
+    original scripts"""
+    return RandomState(seed).permutation(n) % K
+
+def _fold(X, y, w, train_rows, burnin, kwargs):
+    return train(X[train_rows], y[train_rows], w[train_rows], 
+                 burnin=None if burnin is None else burnin[train_rows], **kwargs)
+
+def kfold(X, y, w, K=2, fold=None, trainable=None, burnin=None, link='exp', N=0, **kwargs):
+    """Trains on all-but-one fold and predicts the held-out one, for each of the `K` folds. Rows that aren't
+    `trainable` - ones without a good enough parallax, say - are never trained on but are still predicted.
+    Returns the out-of-fold predictions and each fold's coefficients.
+
+    The folds are independent, so pass `N=K` to train them side by side in processes; `X` is shared
+    with them rather than copied. `kwargs` go to `solve`."""
+    fold = folds(len(y), K) if fold is None else sp.asarray(fold)
+    trainable = sp.ones(len(y), dtype=bool) if trainable is None else sp.asarray(trainable, dtype=bool)
+    burnin = None if burnin is None else sp.asarray(burnin, dtype=bool)
+    kwargs['link'] = link
+
+    with tools.parallel(_fold, N=N) as p:
+        bs = p.wait({k: p(X, y, w, (fold != k) & trainable, burnin, kwargs) for k in range(K)})
+
+    g, _ = LINKS[link]
+    predictions = sp.full(len(y), sp.nan)
+    for k in range(K):
+        predictions[fold == k] = g(X[fold == k] @ bs[k])
+    return predictions, [bs[k] for k in range(K)]
+
+def _predict(b, catalog, normed, errors, pixels):
+    # Both matrices need to know where each star's spectrum is, so only look that up once
+    rows = _rows(normed, catalog)
+    X, m, _ = _design_matrix(catalog, normed, pixels, rows)
+    prediction = {'parallax': sp.exp(X @ b)}
+    if errors:
+        # Square and weight the errors in place, then split the variance between the photometry and the spectra
+        E = design_errors(catalog, normed, pixels, rows)
+        E **= 2
+        E *= b**2
+        spectral = m == 1
+        variance = {'photometric': E[:, ~spectral].sum(1), 'spectral': E[:, spectral].sum(1)}
+        prediction['error'] = prediction['parallax']*sp.sqrt(variance['photometric'] + variance['spectral'])
+        for k, v in variance.items():
+            prediction[f'error_{k}'] = prediction['parallax']*sp.sqrt(v)
+    return pd.DataFrame(prediction, catalog.index)
+
+# The biggest a pixel's term in the design matrix can be, since the fluxes are clipped to [.01, 1.2] first
+MAX_LOG_FLUX = abs(sp.log(.01))
+
+def active(model, normed, tol=1e-3):
+    """The coefficients of `model` restricted to the photometry and the pixels that matter, along with the 
+    wavelengths of those pixels. 
+    
+    The L1 penalty pushes most of the pixels towards zero, but the optimizer never gets them exactly there. 
+    So the smallest pixels are dropped for as long as the most they could change any star's log-parallax 
+    by - the sum of their coefficients times the biggest log-flux - stays within `tol`. The default moves 
+    predicted parallaxes by at most 0.1%; pass `tol=0` to keep every non-zero pixel."""
+    b = sp.asarray(model)
+    pixels = normed.flux.columns
+    photometry, spectral = b[:len(b) - len(pixels)], b[len(b) - len(pixels):]
+    order = sp.argsort(sp.fabs(spectral))
+    dropped = sp.cumsum(sp.fabs(spectral[order]))*MAX_LOG_FLUX <= tol
+    keep = sp.ones(len(spectral), dtype=bool)
+    keep[order[dropped]] = False
+    log.info(f'{keep.sum()} of {len(keep)} pixels are active')
+    return sp.concatenate([photometry, spectral[keep]]), pixels[keep]
+
+@metrics.timed(items=len)
+def predict(model, catalog, normed, errors=True, block=10000, tol=1e-3):
+    """Predicts the parallax of every star in `catalog` from the coefficients `model` that `fit` returns.
+    With `errors`, the photometric and spectral errors are pushed through the model too, giving a total 
+    error and the photometric-only and spectral-only parts of it.
+    
+    Pixels whose coefficients are too small to move the log-parallaxes by more than `tol` between them are 
+    dropped - see `active` - and only the rest are read and transformed. Passing the spectra as a 
+    pixel-major store from `data.store_spectra` rather than a frame means the others aren't even loaded.
+    
+    Stars are handled `block` at a time, so only a block's worth of design matrix is ever in memory."""
+    b, pixels = active(model, normed, tol)
+    blocks = [_predict(b, tools.take(catalog, sp.arange(i, min(i+block, len(catalog)))), normed, errors, pixels) for i in range(0, len(catalog), block)]
+    return pd.concat(blocks) if blocks else _predict(b, catalog, normed, errors, pixels)
+
 def plot(b, cols):
     b = pd.Series(b, cols)
     b.apogee.plot()
     pass
 
+@metrics.timed(items=len)
 def training_catalog(catalog):
     cuts = {
-        'finite_parallax': catalog.gaia.parallax < sp.inf,
-        'multiobservation': catalog.gaia.visibility_periods_used >= 8,
-        'low_error': catalog.gaia.parallax_error < .1,
+        'finite_parallax': lambda c: c.gaia.parallax < sp.inf,
+        'multiobservation': lambda c: c.gaia.visibility_periods_used >= 8,
+        'low_error': lambda c: c.gaia.parallax_error < .1,
         # This thresholds the goodness-of-fit of the astrometric solution to the observations made, along the scan direction
-        'coryn': catalog.gaia.astrometric_chi2_al/sp.sqrt(catalog.gaia.astrometric_n_good_obs_al - 5) <= 35}
+        'coryn': lambda c: c.gaia.astrometric_chi2_al/sp.sqrt(c.gaia.astrometric_n_good_obs_al - 5) <= 35}
     return tools.cut(catalog, cuts)
 
 def save(b):
-    path = aws.s3.Path('alj.data/params/b')
+    path = storage.Path('alj.data/params/b')
     path.write_bytes(pickle.dumps(b))
     pass
 
-def fit(catalog, normed):
-    training = training_catalog(catalog)
+def fit(catalog, normed, path=None):
+    """Cuts `catalog` down to the training set and fits the model to it. See `fit_training`."""
+    return fit_training(training_catalog(catalog), normed, path)
+
+def fit_training(training, normed, path=None):
+    """Fits the model to a catalog that's already been through `training_catalog`. If `path` is given, the 
+    design matrix is written there and streamed from disk rather than held in memory."""
     good = (training.gaia.parallax_over_error > 20)
 
-    X, m, cols = design_matrix(training, normed)
+    if path is None:
+        X, m, cols = design_matrix(training, normed)
+    else:
+        X, m, cols = blocked_design_matrix(training, normed, path)
     y = training.gaia.parallax.values + PARALLAX_OFFSET
     w = 1/training.gaia.parallax_error.values**2
 
     #TODO: Replace this 'good' initialization with an explicit prior. Which is all it is really. 
     # Gonna need a strooooong prior to overcome the `exp` in the loss. L2 won't cut it.
-    b = solve(X[good].copy(), y[good], w[good], m)
-    b = solve(X, y, w, m, b)
+    b = train(X, y, w, burnin=good.values, m=m)
 
-    #TODO: Propogate the errors. Physicists pay attention to the second moment, weird.
-    # Xe = design_errors(training, normed)
-    # ye = training.gaia.parallax_error
+    # Errors are propagated at prediction time; see `predict`
+    return b
     
\ No newline at end of file
@@ -0,0 +1,138 @@
+"""Mass models for the rotation curve, and MCMC fits of them.
+
+The circular-velocity profiles broadcast over their parameters, so a column of walkers' parameters against
+a row of radii gives every walker's curve at once. That lets the log-probability be evaluated for the whole
+ensemble in one call, which is what emcee's `vectorize=True` wants:
+
+    p0 = initial_ball(100, [7.3e11, 12.75])
+    chain, log_prob = sample('virial', R, vc, sigma, p0, lower=[1e10, 0], upper=[1e15, 50], path='alj.data/rotation/virial')
+
+The stellar components don't depend on the parameters being fitted, so their curve is computed once when
+the log-probability is set up. Passing a `path` checkpoints the chain to storage as it goes, and a later call
+with the same path picks up where it left off.
+
+Radii are in kpc, masses in solar masses, densities in solar masses per cubic kpc and velocities in km/s.
+"""
+import pickle
+import logging
+import scipy as sp
+from numpy.random import RandomState
+from .aws import storage
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+# Gravitational constant in kpc (km/s)^2 / Msun
+G = 4.300917270036279e-06
+
+# Critical density for Planck 2013's H0 of 67.77 km/s/Mpc, in Msun/kpc^3
+H0 = 67.77e-3 # km/s/kpc
+RHO_C = 3*H0**2/(8*sp.pi*G)
+
+X_SUN = 8.122 # kpc
+
+# The stellar components, after model I of Pouliasis et al. 2016. Masses are multiples of 2.32e7 Msun.
+BULGE = {'b': .3, 'M': 460*2.32e7}
+THIN_DISK = {'a': 5.3, 'b': .25, 'M': 1700*2.32e7}
+THICK_DISK = {'a': 2.6, 'b': .8, 'M': 1700*2.32e7}
+
+def vc_miyamoto_nagai(R, a, b, M, z=0.):
+    return R*sp.sqrt(G*M/(R**2 + (a + sp.sqrt(z**2 + b**2))**2)**1.5)
+
+def vc_plummer(R, b, M):
+    return R*sp.sqrt(G*M/(R**2 + b**2)**1.5)
+
+def vc_nfw(R, a, rho_0, z=0.):
+    """NFW halo with scale radius `a` and density `rho_0`"""
+    r = sp.sqrt(R**2 + z**2)
+    b = 4*sp.pi*G*rho_0
+    return R*sp.sqrt(b*a**3*(sp.log1p(r/a)/r**3 - 1/(r**2*(r + a))))
+
+def vc_nfw_virial(R, M_vir, c, z=0., rho_c=RHO_C):
+    """NFW halo with virial mass `M_vir` and concentration `c`"""
+    R_vir = sp.cbrt(M_vir/200/rho_c/(4*sp.pi/3))
+    a = R_vir/c
+    rho_0 = M_vir/(4*sp.pi)/a**3/(sp.log1p(c) - c/(1 + c))
+    return vc_nfw(R, a, rho_0, z)
+
+def vc_stars(R):
+    return sp.sqrt(vc_plummer(R, **BULGE)**2 + vc_miyamoto_nagai(R, **THIN_DISK)**2 + vc_miyamoto_nagai(R, **THICK_DISK)**2)
+
+# Each model takes a list of parameter columns, the radii and the stellar curve squared
+MODELS = {
+    'nfw': lambda theta, R, stars2: sp.sqrt(stars2 + vc_nfw(R, *theta)**2),
+    'virial': lambda theta, R, stars2: sp.sqrt(stars2 + vc_nfw_virial(R, *theta)**2),
+    'linear': lambda theta, R, stars2: theta[0]*(R - X_SUN) + theta[1]}
+
+class LogProb(object):
+    """The log-probability of the observed curve `vc +- sigma` at radii `R` under `model`, with a flat prior
+    between `lower` and `upper`. Call with an `(n_walkers, n_params)` array to get every walker's
+    log-probability, or with a single walker's parameters to get a float."""
+
+    def __init__(self, model, R, vc, sigma, lower, upper):
+        self.model = model
+        self.R, self.vc, self.sigma = [sp.asarray(x, dtype=float) for x in (R, vc, sigma)]
+        self.lower, self.upper = sp.asarray(lower, dtype=float), sp.asarray(upper, dtype=float)
+        self.stars2 = vc_stars(self.R)**2
+
+    def __call__(self, theta):
+        theta = sp.asarray(theta, dtype=float)
+        walkers = sp.atleast_2d(theta)
+        inside = ((self.lower < walkers) & (walkers < self.upper)).all(1)
+        with sp.errstate(invalid='ignore', divide='ignore'):
+            fit = MODELS[self.model]([c[:, None] for c in walkers.T], self.R[None, :], self.stars2[None, :])
+        lnlike = sp.nansum(-.5*(fit - self.vc)**2/self.sigma**2, 1)
+        lp = sp.where(inside, lnlike, -sp.inf)
+        return lp if theta.ndim == 2 else lp[0]
+
+def initial_uniform(n_walkers, lower, upper, seed=42):
+    lower, upper = sp.asarray(lower, dtype=float), sp.asarray(upper, dtype=float)
+    return lower + RandomState(seed).uniform(size=(n_walkers, len(lower)))*(upper - lower)
+
+def initial_ball(n_walkers, guess, scale=.1, seed=42):
+    """Walkers scattered around `guess` with a standard deviation of `scale` times each parameter"""
+    guess = sp.asarray(guess, dtype=float)
+    return guess*(1 + scale*RandomState(seed).normal(size=(n_walkers, len(guess))))
+
+def _load(path):
+    if path is None or not storage.Path(path).exists():
+        return None
+    return pickle.loads(storage.Path(path).read_bytes())
+
+@metrics.timed()
+def sample(model, R, vc, sigma, p0, lower, upper, n_steps=2000, pool=None, path=None, checkpoint=100,
+           seed=42, progress=True):
+    """Runs emcee from the `(n_walkers, n_params)` starting positions `p0`. Returns the chain as
+    `(n_steps, n_walkers, n_params)` and the log-probabilities as `(n_steps, n_walkers)`.
+
+    Without a `pool`, each step evaluates every walker in a single vectorized call. With one - anything with
+    a `map`, like a `multiprocessing.Pool` - the walkers are farmed out one by one instead, which is only
+    worth it for a model much more expensive than these.
+
+    If `path` is given, the chain is saved there every `checkpoint` steps, and if there's already a chain
+    there it's resumed rather than restarted.
+    """
+    import emcee
+
+    f = LogProb(model, R, vc, sigma, lower, upper)
+    n_walkers, n_params = sp.shape(p0)
+    sampler = emcee.EnsembleSampler(n_walkers, n_params, f, pool=pool, vectorize=pool is None)
+
+    saved = _load(path)
+    if saved is None:
+        chain, log_prob = sp.zeros((0, n_walkers, n_params)), sp.zeros((0, n_walkers))
+        state = emcee.State(sp.asarray(p0, dtype=float), random_state=RandomState(seed).get_state())
+    else:
+        chain, log_prob = saved['chain'], saved['log_prob']
+        state = emcee.State(chain[-1], log_prob=log_prob[-1], random_state=saved['random_state'])
+        log.info(f'Resuming from step {len(chain)} of {n_steps}')
+
+    while len(chain) < n_steps:
+        sampler.reset()
+        state = sampler.run_mcmc(state, min(checkpoint, n_steps - len(chain)), progress=progress)
+        chain = sp.concatenate([chain, sampler.get_chain()])
+        log_prob = sp.concatenate([log_prob, sampler.get_log_prob()])
+        if path is not None:
+            storage.Path(path).write_bytes(pickle.dumps({
+                'chain': chain, 'log_prob': log_prob, 'random_state': state.random_state}))
+    return chain, log_prob
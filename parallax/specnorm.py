@@ -1,9 +1,7 @@
-from tqdm import tqdm
 import pandas as pd 
 import scipy as sp
 from numpy.polynomial.chebyshev import Chebyshev
-from multiprocessing import cpu_count
-from . import tools
+from . import tools, metrics
 
 #TODO: This is smaller than many errors encountered in practice
 ERROR_LIM = 3.0
@@ -63,7 +61,8 @@ def _normalize(spectra):
     
     return pd.concat({'flux': norm_flux, 'error': norm_error}, 1)
 
-def normalize(spectra, size=1000):
-    chunks = [spectra[i:i+size] for i in range(0, len(spectra), size)]
-    with tools.parallel(_normalize) as p:
-        return pd.concat(p.wait(p(c) for c in chunks))
\ No newline at end of file
+@metrics.timed(items=len)
+def normalize(spectra, size=None, **kwargs):
+    size = tools.chunksize(len(spectra), kwargs.get('N'), lower=100, upper=1000) if size is None else size
+    with tools.parallel(_normalize, **kwargs) as p:
+        return pd.concat(p.imap(tools.chunks(spectra, size)))
\ No newline at end of file
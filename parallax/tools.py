@@ -1,15 +1,16 @@
-import sys
 import logging
-import matplotlib.pyplot as plt
-plt.rcParams['figure.figsize'] = (12, 8)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
-
 import scipy as sp
-from tqdm import tqdm
 from contextlib import contextmanager
 import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
 import types
+import os
+import threading
+from collections import deque, OrderedDict
+import time
+from . import metrics, aws
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, _base, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 log = logging.getLogger(__name__)
 
@@ -22,32 +23,289 @@ class SerialExecutor(_base.Executor):
         pass
     
     def submit(self, f, *args, **kwargs):
+        # Exceptions go on the future like they would with a pool, so `parallel` can record them. Re-raising 
+        # it keeps the original traceback, so `pdb.pm()` still lands in `f`.
         future = Future()
-        future.set_result(f(*args, **kwargs))
+        try:
+            future.set_result(f(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
         return future
 
+class RespawningExecutor(_base.Executor):
+    """Wraps a process pool so that it can be replaced when it breaks. A pool breaks for good if any of its 
+    workers dies abruptly - say from the OOM killer or a segfault in a C extension - and every task that 
+    was submitted to it fails with a `BrokenProcessPool`. 
+
+    Each future is tagged with the `generation` of the pool it was submitted to, so that when a dozen 
+    futures all report the same breakage, the pool only gets respawned once.
+    """
+
+    def __init__(self, N, initializer=None, initargs=()):
+        self._N = N
+        self._initializer, self._initargs = initializer, initargs
+        self._pool = self._spawn()
+        self.generation = 0
+
+    def _spawn(self):
+        return ProcessPoolExecutor(self._N, initializer=self._initializer, initargs=self._initargs)
+
+    def respawn(self, generation=None):
+        if generation is not None and generation != self.generation:
+            return # Someone else has already respawned it
+        log.warning(f'Process pool broke; respawning it (generation {self.generation + 1})')
+        self._pool.shutdown(wait=False)
+        self._pool = self._spawn()
+        self.generation += 1
+
+    def submit(self, f, *args, **kwargs):
+        try:
+            fut = self._pool.submit(f, *args, **kwargs)
+        except BrokenProcessPool:
+            self.respawn()
+            fut = self._pool.submit(f, *args, **kwargs)
+        fut.generation = self.generation
+        return fut
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+# Environment variables read by the various BLAS and OpenMP implementations when they're loaded
+THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+_limits = None
+def limit_threads(n):
+    """Limits the BLAS and OpenMP thread pools in this process to `n` threads. Forked workers inherit libraries
+    that are already loaded, so the environment variables alone come too late - threadpoolctl is used to
+    resize the live pools if it's installed."""
+    global _limits
+    for v in THREAD_VARS:
+        os.environ[v] = str(n)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        log.debug('threadpoolctl is not installed, so only BLAS libraries loaded from here on will be limited')
+        return
+    _limits = threadpool_limits(limits=n)
+
 @contextmanager
-def VariableExecutor(N=None, processes=True):
+def VariableExecutor(N=None, processes=True, threads=None):
     """An executor that can be easily switched between serial, thread and parallel execution.
 
-    If N=0, a serial executor will be used.
+    If N=0, a serial executor will be used. Process pools are wrapped in a `RespawningExecutor`.
+
+    Each worker process would otherwise get a BLAS that uses every core, so N workers doing linear algebra 
+    would run N times as many threads as there are cores. Instead each worker's BLAS is limited to `threads` 
+    threads, which defaults to an even split of the cores between the workers. Pass `threads=0` to leave 
+    them alone.
     """
     
     N = multiprocessing.cpu_count() if N is None else N
     
+    kwargs = {}
     if N == 0:
         executor = SerialExecutor
     elif processes:
-        executor = ProcessPoolExecutor
+        executor = RespawningExecutor
+        threads = max(multiprocessing.cpu_count() // N, 1) if threads is None else threads
+        if threads:
+            kwargs = {'initializer': limit_threads, 'initargs': (threads,)}
     else:
         executor = ThreadPoolExecutor
     
     log.debug('Launching a {} with {} processes'.format(executor.__name__, N))    
-    with executor(N) as pool:
+    with executor(N, **kwargs) as pool:
         yield pool
         
+class SharedArray(object):
+    """A handle on an array that's been copied into a shared memory block. It pickles down to a few 
+    dozen bytes, and unpickling it attaches to the block rather than copying the data."""
+
+    def __init__(self, name, shape, dtype):
+        self.name, self.shape, self.dtype = name, shape, dtype
+
+    @classmethod
+    def create(cls, array):
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        sp.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+        return cls(shm.name, array.shape, array.dtype), shm
+
+    def attach(self):
+        shm = shared_memory.SharedMemory(name=self.name)
+        return sp.ndarray(self.shape, self.dtype, buffer=shm.buf), shm
+
+    def unlink(self):
+        """Frees the block, if it hasn't been already"""
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+def _start_tracker():
+    # The workers need to share the parent's resource tracker, else each starts its own and unlinks the 
+    # blocks it's returned when it exits. Workers are only forked on the first submit, so starting the 
+    # tracker when the pool's set up is early enough. 
+    resource_tracker.ensure_running()
+
+def _shareable(x, size):
+    return (size is not None) and isinstance(x, sp.ndarray) and (x.dtype != object) and (x.nbytes >= size)
+
+class SharedCall(object):
+    """Wraps `f` so that `SharedArray` arguments are attached on the worker, and big array results are 
+    passed back through shared memory too. Results are either returned whole or as the elements of a 
+    tuple."""
+
+    def __init__(self, f, size):
+        self.f, self.size = f, size
+
+    def _share(self, x):
+        if _shareable(x, self.size):
+            handle, shm = SharedArray.create(x)
+            shm.close()
+            return handle
+        # Small arrays might be views of a shared block that's about to be closed
+        return x.copy() if isinstance(x, sp.ndarray) else x
+
+    def __call__(self, *args, **kwargs):
+        blocks = []
+        def attach(x):
+            if isinstance(x, SharedArray):
+                x, shm = x.attach()
+                blocks.append(shm)
+            return x
+
+        try:
+            args = [attach(a) for a in args]
+            kwargs = {k: attach(v) for k, v in kwargs.items()}
+            result = self.f(*args, **kwargs)
+            results = result if isinstance(result, tuple) else (result,)
+            shared = []
+            try:
+                for r in results:
+                    shared.append(self._share(r))
+            except Exception:
+                # Nobody will ever hear about the blocks made so far, so free them here
+                for r in shared:
+                    if isinstance(r, SharedArray):
+                        r.unlink()
+                raise
+            return tuple(shared) if isinstance(result, tuple) else shared[0]
+        finally:
+            del args, kwargs
+            for shm in blocks:
+                try:
+                    shm.close()
+                except BufferError:
+                    # Something in the result still refers to the block. It'll get closed when that's 
+                    # garbage collected instead.
+                    pass
+
+def _unshare(x):
+    """Copies an array out of the shared block it was returned in, and frees the block"""
+    if isinstance(x, SharedArray):
+        array, shm = x.attach()
+        x = array.copy()
+        del array
+        shm.close()
+        shm.unlink()
+    return x
+
+class TimedCall(object):
+    """Wraps `f` so it returns its result along with which worker ran it, when, and how many bytes it moved 
+    through storage. A worker process's storage counters are its own, so the parent needs telling. On 
+    threads the counters are shared, so the bytes of tasks running at the same time get mixed up."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, *args, **kwargs):
+        start = time.time()
+        read, written = aws.BYTES['read'], aws.BYTES['written']
+        result = self.f(*args, **kwargs)
+        worker = f'{os.getpid()}/{threading.current_thread().name}'
+        return result, (worker, start, time.time(), aws.BYTES['read'] - read, aws.BYTES['written'] - written)
+
+def _merge(timing):
+    """Adds the storage traffic of a task that ran in another process to this one's counters, so that the 
+    stages it ran inside can see it"""
+    worker, _, _, read, written = timing
+    if not worker.startswith(f'{os.getpid()}/'):
+        aws.BYTES['read'] += read
+        aws.BYTES['written'] += written
+
+class Summary(object):
+    """Keeps track of the tasks run by `parallel`: how many are in flight, which worker ran each one and how
+    long it took. Use it to tune chunk sizes and worker counts - low utilization with a deep queue means the 
+    tasks are too small to be worth shipping to a worker; a few slow tasks hogging the end of a run means 
+    they're too big."""
+
+    def __init__(self, N):
+        self.N = max(N, 1)
+        self.started = time.time()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._tasks = []
+        # Running totals, so the progress bar doesn't have to go back over every task on each tick
+        self._duration = 0.
+        self._busy = {}
+
+    def submitted(self):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finished(self, key, timing=None):
+        self.in_flight -= 1
+        if timing is not None:
+            self._tasks.append((key,) + timing)
+            worker, start, end = timing[:3]
+            self._duration += end - start
+            self._busy[worker] = self._busy.get(worker, 0.) + end - start
+
+    @property
+    def queue(self):
+        """Tasks that have been submitted but can't have been picked up by a worker yet"""
+        return max(self.in_flight - self.N, 0)
+
+    def tasks(self):
+        import pandas as pd
+        tasks = pd.DataFrame(self._tasks, columns=['key', 'worker', 'start', 'end', 'bytes_read', 'bytes_written'])
+        tasks['duration'] = tasks.end - tasks.start
+        return tasks
+
+    @property
+    def wall(self):
+        return time.time() - self.started
+
+    @property
+    def throughput(self):
+        return len(self._tasks)/max(self.wall, 1e-9)
+
+    def busy(self):
+        """Seconds each worker spent running tasks"""
+        import pandas as pd
+        return pd.Series(self._busy, name='duration').rename_axis('worker').sort_index()
+
+    @property
+    def utilization(self):
+        return self._duration/(self.N*max(self.wall, 1e-9))
+
+    def slowest(self, n=5):
+        return self.tasks().nlargest(n, 'duration').set_index('key').duration
+
+    def postfix(self):
+        return {'queue': self.queue, 'util': f'{self.utilization:.0%}'}
+
+    def __repr__(self):
+        slowest = ', '.join(f'{k}: {v:.2f}s' for k, v in self.slowest(3).items())
+        return (f'{len(self._tasks)} tasks in {self.wall:.1f}s ({self.throughput:.1f}/s) on {self.N} workers; '
+                f'{self.utilization:.0%} utilization, max {self.max_in_flight} in flight. Slowest: {slowest}')
+
+_failed = object()
+
 @contextmanager
-def parallel(f, progress=True, **kwargs):
+def parallel(f, progress=True, retries=2, errors='raise', share=2**20, **kwargs):
     """Sugar for using the VariableExecutor. Call as
     
     with parallel(f) as g:
@@ -57,54 +315,258 @@ def parallel(f, progress=True, **kwargs):
 
     A fantastic additonal feature is that if you pass `parallel(f, N=0)` , everything will be run on 
     the host process, so you can `import pdb; pdb.pm()` any errors. 
+
+    `wait` submits everything at once. If the inputs are big, use `imap` instead:
+
+    with parallel(f) as g:
+        for y in g.imap(xs):
+            ...
+
+    which yields the results in order while only ever keeping `window` inputs in flight. By default the 
+    window is twice the number of workers.
+
+    If the process pool breaks, it's respawned and the tasks that were lost are resubmitted, up to 
+    `retries` times each. Other exceptions are raised as normal, unless `errors='record'` - in which case 
+    they're logged and stored in `g.failures` under the task's key. A failed task is left out of `wait`'s 
+    results when it's given a dict, and comes back as None when it's given a list, so that the others keep 
+    their positions. `imap` yields None for it too.
+
+    When running on processes, array arguments and results bigger than `share` bytes are passed through 
+    shared memory rather than being pickled. An array that's passed to several tasks is only copied into 
+    shared memory once, and all the blocks are freed when the context exits. Pass `share=None` to turn
+    this off.
+
+    Every task is timed. The progress bar shows the queue depth and worker utilization as it goes, and 
+    `g.summary` is a `Summary` of the tasks so far - throughput, per-worker busy time, per-task storage 
+    traffic and the slowest tasks. The storage traffic of tasks run on worker processes is also added to 
+    this process's counters, so the `metrics` stages around the call see it. 
+    `g.wait(c, summary=True)` returns it alongside the results.
     """
+    # Imported here rather than up top, so the workers - which import this module too - don't pay for it
+    from tqdm import tqdm
 
-    with VariableExecutor(**kwargs) as pool:
+    N = kwargs.get('N')
+    N = multiprocessing.cpu_count() if N is None else N
+    with metrics.stage(f'parallel:{getattr(f, "__qualname__", f)}') as record, VariableExecutor(**kwargs) as pool:
+        record.update({'workers': N, 'items': 0})
 
+        sharing = (share is not None) and isinstance(pool, RespawningExecutor)
+        if sharing:
+            _start_tracker()
+        target = TimedCall(SharedCall(f, share) if sharing else f)
+        summary = Summary(N)
+
+        blocks = {}
+        def shared(x):
+            if not (sharing and _shareable(x, share)):
+                return x
+            if id(x) not in blocks:
+                # Keep a reference to the array, so its id can't be reused by another one
+                handle, shm = SharedArray.create(x)
+                blocks[id(x)] = (handle, shm, x)
+            return blocks[id(x)][0]
+
+        # The names of the blocks that workers have returned results in and that haven't been copied out 
+        # and freed yet. Results that are never collected - from an abandoned `imap`, say - would otherwise 
+        # leak their blocks.
+        returned = set()
+        def track(fut):
+            if fut.cancelled() or fut.exception() is not None:
+                return
+            result, _ = fut.result()
+            for r in (result if isinstance(result, tuple) else (result,)):
+                if isinstance(r, SharedArray):
+                    returned.add(r.name)
+
+        def unshare(result):
+            for r in (result if isinstance(result, tuple) else (result,)):
+                if isinstance(r, SharedArray):
+                    returned.discard(r.name)
+            if isinstance(result, tuple):
+                return tuple(_unshare(r) for r in result)
+            return _unshare(result)
+
+        failures = {}
         def reraise(f, futures={}):
+            record['items'] += 1
             e = f.exception()
             if e:
+                summary.finished(futures[f])
                 log.warning('Exception raised on "{}"'.format(futures[f]), exc_info=e)
+                if errors == 'record':
+                    failures[futures[f]] = e
+                    return _failed
                 raise e
-            return f.result()
+            result, timing = f.result()
+            _merge(timing)
+            summary.finished(futures[f], timing)
+            return unshare(result)
 
         submitted = set()
+        calls = {}
         def submit(*args, **kwargs):
-            fut = pool.submit(f, *args, **kwargs)
+            args = [shared(a) for a in args]
+            kwargs = {k: shared(v) for k, v in kwargs.items()}
+            fut = pool.submit(target, *args, **kwargs)
+            summary.submitted()
             submitted.add(fut)
             fut.add_done_callback(submitted.discard) # Try to avoid memory leak
+            if sharing:
+                fut.add_done_callback(track)
+            if isinstance(pool, RespawningExecutor):
+                # Hang on to the arguments in case the pool breaks and the task needs resubmitting
+                calls[fut] = (args, kwargs, 0)
             return fut
+
+        def broken(fut):
+            return (fut in calls) and isinstance(fut.exception(), BrokenProcessPool) and (calls[fut][2] < retries)
+
+        def resubmit(fut):
+            args, kwargs, attempts = calls.pop(fut)
+            summary.in_flight -= 1
+            pool.respawn(fut.generation)
+            new = submit(*args, **kwargs)
+            calls[new] = (args, kwargs, attempts + 1)
+            return new
+
+        def settle(fut, key):
+            while broken(fut):
+                log.warning(f'Task "{key}" was lost with the process pool; resubmitting it')
+                fut = resubmit(fut)
+            calls.pop(fut, None)
+            result = reraise(fut, {fut: key})
+            return None if result is _failed else result
         
-        def wait(c):
+        def wait(c, summary=False):
+            if summary:
+                return wait(c), submit.summary
+
             # Recurse on list-likes
             if type(c) in (list, tuple, types.GeneratorType):
                 ctor = list if isinstance(c, types.GeneratorType) else type(c)
-                results = wait(dict(enumerate(c)))
-                return ctor(results[k] for k in sorted(results))
+                c = dict(enumerate(c))
+                results = wait(c)
+                return ctor(results.get(k) for k in range(len(c)))
 
             # Now can be sure we've got a dict-like
             futures = {fut: k for k, fut in c.items()}
             
             results = {}
-            for fut in tqdm(as_completed(futures), total=len(c), disable=not progress):
-                results[futures[fut]] = reraise(fut, futures)
+            with tqdm(total=len(c), disable=not progress) as pbar:
+                while futures:
+                    # Tasks lost to a broken pool are collected up and resubmitted together once
+                    # everything else has finished, so the retries run in parallel too
+                    lost = {}
+                    for fut in as_completed(futures):
+                        k = futures[fut]
+                        if broken(fut):
+                            lost[fut] = k
+                            continue
+                        calls.pop(fut, None)
+                        result = reraise(fut, futures)
+                        if result is not _failed:
+                            results[k] = result
+                        pbar.set_postfix(submit.summary.postfix(), refresh=False)
+                        pbar.update(1)
+
+                    if lost:
+                        log.warning(f'{len(lost)} tasks were lost with the process pool; resubmitting them')
+                    futures = {resubmit(fut): k for fut, k in lost.items()}
                 
             return results
+
+        def imap(xs, window=None):
+            window = max(2*N, 1) if window is None else window
+            total = len(xs) if hasattr(xs, '__len__') else None
+
+            in_flight = deque()
+            with tqdm(total=total, disable=not progress) as pbar:
+                for i, x in enumerate(xs):
+                    in_flight.append((submit(x), i))
+                    if len(in_flight) >= window:
+                        yield settle(*in_flight.popleft())
+                        pbar.set_postfix(summary.postfix(), refresh=False)
+                        pbar.update(1)
+                while in_flight:
+                    yield settle(*in_flight.popleft())
+                    pbar.set_postfix(summary.postfix(), refresh=False)
+                    pbar.update(1)
         
         def cancel():
+            """Cancels everything that hasn't started yet, and returns what's still running"""
+            running = []
             while True:
                 remaining = list(submitted)
                 for fut in remaining:
-                    fut.cancel()
+                    if not fut.cancel() and not fut.done():
+                        running.append(fut)
                     submitted.discard(fut)
                 if not remaining:
                     break
+            calls.clear()
+            return running
+
+        def free(running):
+            # Anything still running might be using an argument's block, or yet return one of its own, so 
+            # let it finish first
+            _base.wait(running)
+            for handle, shm, _ in blocks.values():
+                shm.close()
+                shm.unlink()
+            blocks.clear()
+
+            # The results that were never collected, or were lost between the workers and here
+            for name in list(returned):
+                SharedArray(name, None, None).unlink()
+            returned.clear()
 
         try:
             submit.wait = wait
+            submit.imap = imap
+            submit.failures = failures
+            submit.summary = summary
             yield submit
         finally:
-            cancel()
+            free(cancel())
+            if summary._tasks:
+                record.update({'utilization': summary.utilization, 'max_in_flight': summary.max_in_flight})
+                log.info(f'{getattr(f, "__qualname__", f)}: {summary}')
+
+def _blas_task(size, seed):
+    import scipy.linalg
+    from numpy.random import RandomState
+    A = RandomState(seed).standard_normal((size, size))
+    return sp.linalg.solve(A @ A.T + sp.eye(size), A).sum()
+
+def benchmark_threads(N=None, size=1500, tasks=None):
+    """Times a batch of BLAS-heavy tasks on a process pool with each worker's BLAS left to use every core, 
+    and then with the cores split between the workers. Needs a multi-core machine to show a difference."""
+    import pandas as pd
+    N = multiprocessing.cpu_count() if N is None else N
+    tasks = 4*N if tasks is None else tasks
+
+    results = {}
+    for name, threads in [('unlimited', 0), ('split', None)]:
+        start = time.time()
+        with parallel(_blas_task, N=N, threads=threads, progress=False) as p:
+            p.wait([p(size, i) for i in range(tasks)])
+        results[name] = time.time() - start
+    results = pd.Series(results)
+    log.info(f'Splitting the cores between {N} workers is {results.unlimited/results.split:.1f}x faster')
+    return results
+
+def chunksize(n, N=None, per_worker=4, lower=1, upper=None):
+    """Picks a chunk size that splits `n` items into about `per_worker` chunks for each of `N` workers. 
+    More chunks than workers evens out the load; fewer, bigger chunks cut the overhead."""
+    N = multiprocessing.cpu_count() if N is None else N
+    size = -(-n // max(per_worker*max(N, 1), 1))
+    size = max(size, lower)
+    return size if upper is None else min(size, upper)
+
+def chunks(xs, size):
+    """Lazily slices `xs` into chunks of `size`, so only the chunks in flight need to be materialized"""
+    for i in range(0, len(xs), size):
+        yield xs[i:i+size]
 
 def extract():
     """Copies the variables of the caller up to iPython. Useful for debugging.
@@ -137,11 +599,102 @@ def extract():
     message = 'Copied {}\'s variables to {}'.format(caller.f_code.co_name, ipython.f_code.co_name)
     raise RuntimeError(message)
 
-def cut(catalog, cuts):
-    cut = sp.all(sp.vstack(cuts.values()).data, 0)
+def whole(f):
+    """Marks a cut as needing to see the whole catalog rather than just the rows that survived the other
+    cuts - like a duplicate check, where the answer depends on which other rows are around."""
+    f.whole = True
+    return f
+
+def version(catalog):
+    """A fingerprint of a catalog's contents. Catalogs loaded from the column store have their own; for 
+    dataframes it's a hash of the index, the column names and every value, so two frames that share an 
+    index but hold different data - or one frame before and after it's modified in place - don't collide."""
+    if hasattr(catalog, 'version'):
+        return catalog.version
+    import hashlib
+    import pandas as pd
+    md5 = hashlib.md5(repr(list(catalog.columns)).encode())
+    md5.update(pd.util.hash_pandas_object(catalog, index=True).values.tobytes())
+    return md5.hexdigest()
+
+def fingerprint(f):
+    """Identifies a cut by its code, so a cut that's been tweaked doesn't hit the cache"""
+    import hashlib
+    code = f.__code__
+    closure = [c.cell_contents for c in f.__closure__ or ()]
+    return hashlib.md5(repr((code.co_code, code.co_consts, code.co_names, closure)).encode()).hexdigest()
+
+def take(catalog, positions):
+    # Frames select rows with `iloc`; column-store catalogs and arrays with plain indexing
+    return catalog.iloc[positions] if hasattr(catalog, 'iloc') else catalog[positions]
+
+# How many cut masks to keep around. Each is a couple of booleans per row of the catalog it was run on.
+CACHE_SIZE = 64
+
+# Cut masks, keyed on the cut's code and the version of the whole catalog, least recently used first. Each 
+# is a mask over the whole catalog along with which rows of it have actually been evaluated, since most cuts 
+# only get to see the rows that survived the ones before them.
+_masks = OrderedDict()
+# The fraction of rows each cut let through last time it was used, by name
+_survival = {}
+
+def _evaluate(f, catalog, base, surviving):
+    """The mask of cut `f` over the `surviving` rows of `catalog`, whose version is `base`, and how many rows 
+    had to be evaluated for it. Only the rows this cut hasn't seen before are, so the cache is hit whatever 
+    order the cuts run in."""
+    key = (fingerprint(f), base)
+    if key not in _masks:
+        _masks[key] = (sp.zeros(len(catalog), dtype=bool), sp.zeros(len(catalog), dtype=bool))
+    _masks.move_to_end(key)
+    while len(_masks) > CACHE_SIZE:
+        _masks.popitem(last=False)
+    mask, known = _masks[key]
+
+    if getattr(f, 'whole', False):
+        needed = sp.arange(len(catalog)) if not known.all() else sp.arange(0)
+    else:
+        needed = surviving[~known[surviving]]
+    if len(needed) == len(catalog):
+        mask[:] = sp.asarray(f(catalog), dtype=bool)
+    elif len(needed) > 0:
+        mask[needed] = sp.asarray(f(take(catalog, needed)), dtype=bool)
+    known[needed] = True
+    return mask[surviving], len(needed)
+
+def cut(catalog, cuts, report=False):
+    """Applies a dict of cuts, each a function from a catalog to a boolean mask, and returns the rows that 
+    pass all of them. 
+
+    The cuts that did the most cutting last time are run first, and each cut is only evaluated on the rows 
+    that survived the ones before it. Masks are cached on the cut's code and the catalog's contents, row by 
+    row, so re-running after tweaking one cut only re-evaluates that cut - plus the others on whichever rows 
+    it now lets through. Cuts that need the whole catalog should be wrapped in `whole`.
+
+    Returns the surviving catalog. A report of how long each cut took, how many rows it removed and how many 
+    it had to evaluate gets logged, and if `report` is set it's returned alongside the catalog as a frame."""
+    import pandas as pd
+    order = sorted(cuts, key=lambda k: _survival.get(k, 1.))
+    base = version(catalog)
+
+    surviving = sp.arange(len(catalog))
+    stats = {}
+    for k in order:
+        start = time.time()
+        mask, evaluated = _evaluate(cuts[k], catalog, base, surviving)
+        stats[k] = {
+            'time': time.time() - start,
+            'before': len(surviving),
+            'after': int(mask.sum()),
+            'evaluated': evaluated}
+        _survival[k] = mask.mean() if len(mask) else 1.
+        surviving = surviving[mask]
+
+    stats = pd.DataFrame.from_dict(stats, orient='index')
+    stats['cut'] = 1 - stats['after']/stats['before'].clip(lower=1)
 
-    for k, c in cuts.items():
-        log.info(f'{1 - c.mean():>3.0%} of the population is cut away by {k}')
-    log.info(f'{cut.mean():>3.0%} stars remain')
+    for k, r in stats.iterrows():
+        log.info(f'{r.cut:>3.0%} of the remaining population is cut away by {k} in {r.time:.2f}s')
+    log.info(f'{len(surviving)/max(len(catalog), 1):>3.0%} stars remain')
     
-    return catalog[cut]
+    result = take(catalog, surviving)
+    return (result, stats) if report else result
\ No newline at end of file
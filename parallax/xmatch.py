@@ -0,0 +1,105 @@
+"""Local sky cross-matching, for re-matching APOGEE against Gaia and WISE extracts without going through
+the Gaia archive.
+
+Positions are turned into unit vectors and indexed with a KD-tree, so nearest-neighbour matching within
+a radius is a single vectorized query however many sources there are. As an example,
+
+    index = SkyIndex(gaia.ra, gaia.dec, gaia.pmra, gaia.pmdec, epoch=2015.5)
+    idx, sep = index.query(apogee.ra, apogee.dec, radius=1., epoch=2000.)
+
+gives, for each APOGEE star, the row of its Gaia match (or -1) and the separation in arcseconds.
+"""
+import logging
+import scipy as sp
+import scipy.spatial
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+MAS_PER_DEG = 3.6e6
+ARCSEC_PER_DEG = 3.6e3
+
+def unit_vectors(ra, dec):
+    """Takes `ra` and `dec` in degrees and returns an (n, 3) array of unit vectors"""
+    ra, dec = sp.radians(sp.asarray(ra, dtype=float)), sp.radians(sp.asarray(dec, dtype=float))
+    cos_dec = sp.cos(dec)
+    return sp.stack([cos_dec*sp.cos(ra), cos_dec*sp.sin(ra), sp.sin(dec)], -1)
+
+def chord(arcsec):
+    """Converts an angular separation to the straight-line distance between unit vectors"""
+    return 2*sp.sin(sp.radians(arcsec/ARCSEC_PER_DEG)/2)
+
+def arc(chord):
+    """Inverse of `chord`"""
+    return sp.degrees(2*sp.arcsin(sp.clip(chord/2, 0, 1)))*ARCSEC_PER_DEG
+
+def propagate(ra, dec, pmra, pmdec, dt):
+    """Moves positions along their proper motions by `dt` years. Proper motions are in mas/yr, with
+    `pmra` including the cos(dec) factor as it does in Gaia. This is the linear approximation, which is
+    plenty for the ~15 year gap between 2MASS and Gaia. Missing proper motions are treated as zero."""
+    ra, dec = sp.asarray(ra, dtype=float), sp.asarray(dec, dtype=float)
+    pmra, pmdec = sp.nan_to_num(sp.asarray(pmra, dtype=float)), sp.nan_to_num(sp.asarray(pmdec, dtype=float))
+    dec_new = dec + dt*pmdec/MAS_PER_DEG
+    ra_new = ra + dt*pmra/MAS_PER_DEG/sp.cos(sp.radians(dec))
+    return sp.mod(ra_new, 360), sp.clip(dec_new, -90, 90)
+
+class SkyIndex(object):
+    """A KD-tree over the positions of a catalog. If proper motions are given, queries at a different
+    `epoch` will move the catalog to that epoch first."""
+
+    def __init__(self, ra, dec, pmra=None, pmdec=None, epoch=None, leafsize=32):
+        self._ra, self._dec = sp.asarray(ra, dtype=float), sp.asarray(dec, dtype=float)
+        self._pm = None if pmra is None else (sp.asarray(pmra, dtype=float), sp.asarray(pmdec, dtype=float))
+        self._epoch = epoch
+        self._leafsize = leafsize
+        self._trees = {}
+
+    def __len__(self):
+        return len(self._ra)
+
+    def tree(self, epoch=None):
+        key = None if (self._pm is None or epoch is None or epoch == self._epoch) else epoch
+        if key not in self._trees:
+            ra, dec = self._ra, self._dec
+            if key is not None:
+                ra, dec = propagate(ra, dec, *self._pm, epoch - self._epoch)
+            log.info(f'Building index over {len(ra)} sources')
+            self._trees[key] = sp.spatial.cKDTree(unit_vectors(ra, dec), leafsize=self._leafsize)
+        return self._trees[key]
+
+    def query(self, ra, dec, radius=1., epoch=None, workers=-1):
+        """Finds the nearest source within `radius` arcseconds of each position. Returns the index of the
+        match - or -1 if there isn't one - and the separation in arcseconds - or NaN."""
+        tree = self.tree(epoch)
+        distance, index = tree.query(unit_vectors(ra, dec), k=1, distance_upper_bound=chord(radius), workers=workers)
+
+        # cKDTree signals a miss with an infinite distance and an index one past the end
+        found = sp.isfinite(distance)
+        index = sp.where(found, index, -1)
+        separation = sp.where(found, arc(sp.where(found, distance, 0)), sp.nan)
+        return index, separation
+
+    def query_radius(self, ra, dec, radius=1., epoch=None, workers=-1):
+        """Finds every source within `radius` arcseconds of each position, as a list of index arrays"""
+        tree = self.tree(epoch)
+        return tree.query_ball_point(unit_vectors(ra, dec), chord(radius), workers=workers, return_sorted=True)
+
+def match(left, right, radius=1., epoch=None, right_epoch=None, pm=('pmra', 'pmdec'), names=('left', 'right')):
+    """Cross-matches two dataframes with `ra` and `dec` columns, keeping the left rows that have a match
+    within `radius` arcseconds. If `right` has proper motion columns and both epochs are given, it's
+    moved to the left's epoch before matching.
+
+    The result has the left and right columns in separate blocks, as the catalog does, plus the separation
+    in arcseconds."""
+    propagating = (epoch is not None) and (right_epoch is not None) and all(c in right for c in pm)
+    pms = [right[c].values for c in pm] if propagating else [None, None]
+    index = SkyIndex(right.ra.values, right.dec.values, *pms, epoch=right_epoch)
+    idx, sep = index.query(left.ra.values, left.dec.values, radius=radius, epoch=epoch if propagating else None)
+
+    found = idx >= 0
+    log.info(f'Matched {found.sum()} of {len(left)} sources within {radius}"')
+
+    l = left[found].reset_index(drop=True)
+    r = right.iloc[idx[found]].reset_index(drop=True)
+    s = pd.DataFrame({'separation': sep[found]})
+    return pd.concat({names[0]: l, names[1]: r, 'xmatch': s}, axis=1)
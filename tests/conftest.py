@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+from parallax import data, parallax
+
+@pytest.fixture
+def memory_storage(monkeypatch):
+    monkeypatch.setenv('PARALLAX_STORAGE', 'memory')
+    monkeypatch.setattr(data.storage, '_memory', {})
+
+@pytest.fixture
+def stars():
+    """A catalog with every column the design matrix needs, and spectra for all but a few of its stars - 
+    in a different order, and alongside spectra of stars that aren't in it"""
+    n, rs = 60, np.random.RandomState(0)
+    files = np.array([f'apStar-{i}.fits' for i in range(n)])
+    columns = {('apogee', 'file'): [f + '  ' for f in files]}
+    for b in parallax.TMASS_BANDS:
+        columns['apogee', b], columns['apogee', f'{b}_err'] = rs.uniform(8, 12, n), rs.uniform(.01, .05, n)
+    for b in parallax.GAIA_BANDS:
+        columns['gaia', f'phot_{b}_mean_mag'] = rs.uniform(10, 14, n)
+        columns['gaia', f'phot_{b}_mean_flux'] = rs.uniform(1e4, 1e5, n)
+        columns['gaia', f'phot_{b}_mean_flux_error'] = rs.uniform(10, 100, n)
+    for b in parallax.WISE_BANDS:
+        columns['wise', b], columns['wise', f'{b}_error'] = rs.uniform(8, 12, n), rs.uniform(.01, .05, n)
+    columns['gaia', 'parallax'] = rs.uniform(.2, 2, n)
+    columns['gaia', 'parallax_error'] = rs.uniform(.01, .05, n)
+    columns['gaia', 'parallax_over_error'] = columns['gaia', 'parallax']/columns['gaia', 'parallax_error']
+    # Labels that aren't positions, as they wouldn't be after a cut
+    catalog = pd.DataFrame(columns, index=3*np.arange(n) + 5)
+    catalog.columns = pd.MultiIndex.from_tuples(catalog.columns)
+
+    names = np.r_[files[:-3], [f'other-{i}' for i in range(10)]]
+    normed = data.synthetic_spectra(n_stars=len(names), n_pixels=40).astype(float)
+    normed.index = names[rs.permutation(len(names))]
+    return catalog, normed
@@ -0,0 +1,73 @@
+import numpy as np
+from parallax import binning
+
+def _naive_grid(x, y, xs, ys, half):
+    """The loop over cells that the map-making scripts do"""
+    members = {}
+    for i, cx in enumerate(xs):
+        for j, cy in enumerate(ys):
+            members[i, j] = np.flatnonzero((abs(x - cx) < half) & (abs(y - cy) < half))
+    return members
+
+def test_grid_matches_naive_loop():
+    rs = np.random.RandomState(0)
+    x, y = rs.uniform(-3, 3, 500), rs.uniform(-3, 3, 500)
+    x[:5] = np.nan
+    xs, ys = np.arange(-2, 2.01, .5), np.arange(-1, 1.01, .25)
+    values = rs.normal(size=(500, 2))
+    values[10, 0] = np.nan
+
+    bins = binning.grid(x, y, xs, ys, half=.5)
+    members = _naive_grid(x, y, xs, ys, half=.5)
+    count, nanmean, moment = bins.count(), bins.nanmean(values), bins.moment(values[:, 1:])
+    for (i, j), m in members.items():
+        assert count[i, j] == len(m)
+        if len(m):
+            np.testing.assert_allclose(nanmean[i, j], np.nanmean(values[m], 0))
+            np.testing.assert_allclose(moment[i, j, 0, 0], (values[m, 1]**2).mean())
+        else:
+            assert np.isnan(nanmean[i, j]).all()
+
+def test_annuli_matches_naive_loop():
+    rs = np.random.RandomState(1)
+    r = rs.uniform(0, 12, 300)
+    edges = np.array([2., 4.5, 7., 10.])
+    bins = binning.annuli(r, edges)
+    for i in range(len(edges) - 1):
+        expected = np.flatnonzero((r > edges[i]) & (r < edges[i+1]))
+        np.testing.assert_array_equal(np.sort(bins.star[bins.cell == i]), expected)
+    assert len(bins) == ((r > edges[0]) & (r < edges[-1])).sum()
+
+def test_select_drops_stars():
+    bins = binning.annuli(np.array([1., 2., 3.]), np.array([0., 10.]))
+    assert bins.select([True, False, True]).count().tolist() == [2]
+
+def test_bootstrap_weights_resample_within_cells():
+    cell = np.array([0, 2, 0, 2, 2, 0, 1])
+    weights = binning._weights(np.random.default_rng(0), cell, 3, 50)
+    for c in range(3):
+        np.testing.assert_array_equal(weights[:, cell == c].sum(1), (cell == c).sum())
+
+def test_bootstrap_of_identical_stars_is_exact():
+    # Every replicate of a cell full of identical stars is the same, so every percentile is too
+    r = np.array([1., 1.5, 3., 3.5, 3.7])
+    v = np.array([[1., 2.], [1., 2.], [3., 0.], [3., 0.], [3., 0.]])
+    cov = np.broadcast_to(.1*np.eye(2), (5, 2, 2))
+    vt = binning.bootstrap(binning.annuli(r, [0, 2, 4]), v, cov, n_samples=10)
+    assert vt.shape == (3, 2, 2, 2)
+    np.testing.assert_allclose(vt[:, 0], np.broadcast_to(np.outer(v[0], v[0]) - .1*np.eye(2), (3, 2, 2)))
+    np.testing.assert_allclose(vt[:, 1], np.broadcast_to(np.outer(v[2], v[2]) - .1*np.eye(2), (3, 2, 2)))
+
+def test_bootstrap_doesnt_depend_on_workers():
+    rs = np.random.RandomState(2)
+    r, v = rs.uniform(0, 10, 200), rs.normal(size=(200, 3))
+    cov = np.broadcast_to(.01*np.eye(3), (200, 3, 3))
+    bins = binning.annuli(r, np.arange(0, 10.1, 2.5))
+    serial = binning.bootstrap(bins, v, cov, n_samples=30, chunk=7)
+    threaded = binning.bootstrap(bins, v, cov, n_samples=30, chunk=7, N=2, processes=False)
+    np.testing.assert_array_equal(serial, threaded)
+
+    # And the median's close to the dispersion of the whole cell
+    first = bins.star[bins.cell == 0]
+    expected = (v[first, :, None]*v[first, None, :]).mean(0) - .01*np.eye(3)
+    np.testing.assert_allclose(serial[1, 0], expected, atol=.3)
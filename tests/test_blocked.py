@@ -0,0 +1,86 @@
+import pickle
+import numpy as np
+import pytest
+from parallax import blocked, parallax
+
+@pytest.fixture
+def scratch(monkeypatch, tmp_path):
+    # The matrices go under the local storage root, which config.json puts relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/'config.json').write_text('{}')
+
+@pytest.fixture
+def matrices(scratch):
+    dense = np.random.RandomState(0).normal(size=(53, 6))
+    X = blocked.write((dense[i:i+10] for i in range(0, len(dense), 10)), 'bucket/X')
+    # A small block means every product has to stitch several together
+    return blocked.BlockedDesignMatrix(X.path, X.shape, block=8), dense
+
+def test_products_match_dense(matrices):
+    X, dense = matrices
+    rs = np.random.RandomState(1)
+    b, B = rs.normal(size=6), rs.normal(size=(6, 2))
+    v, V = rs.normal(size=53), rs.normal(size=(3, 53))
+
+    assert X.shape == dense.shape
+    np.testing.assert_allclose(X @ b, dense @ b)
+    np.testing.assert_allclose(X @ B, dense @ B)
+    np.testing.assert_allclose(v @ X, v @ dense)
+    np.testing.assert_allclose(V @ X, V @ dense)
+
+@pytest.mark.parametrize('key', [
+    np.arange(53) % 3 == 0,
+    np.array([50, 2, 2, 17, 8, 33]),
+    slice(5, 40, 3)])
+def test_row_selections_match_dense(matrices, key):
+    X, dense = matrices
+    rs = np.random.RandomState(2)
+    selected, expected = X[key], dense[key]
+    b, v = rs.normal(size=6), rs.normal(size=len(expected))
+
+    assert selected.shape == expected.shape
+    np.testing.assert_allclose(selected @ b, expected @ b)
+    np.testing.assert_allclose(v @ selected, v @ expected)
+    # Selections of selections, and ones that have been through a pickle, as they do going to workers
+    mask = np.arange(len(expected)) % 2 == 0
+    np.testing.assert_allclose(pickle.loads(pickle.dumps(selected[mask])) @ b, expected[mask] @ b)
+
+def test_columns_cant_be_selected(matrices):
+    X, _ = matrices
+    with pytest.raises(TypeError):
+        X[:, 0]
+
+def test_blocked_design_matrix_matches_dense(stars, scratch):
+    catalog, normed = stars
+    dense, m, cols = parallax.design_matrix(catalog, normed)
+    X, bm, bcols = parallax.blocked_design_matrix(catalog, normed, 'bucket/X', block=7)
+    assert (bm == m).all() and bcols.equals(cols)
+    np.testing.assert_array_equal(np.concatenate([block for _, block in X.blocks()]), dense)
+    # Stars without spectra come out NaN either way
+    b = np.random.RandomState(3).normal(size=X.shape[1])
+    np.testing.assert_allclose(X @ b, dense @ b)
+
+def test_training_on_blocked_matches_dense(stars, scratch):
+    catalog, normed = stars
+    training = catalog[parallax._rows(normed, catalog) >= 0]
+    dense, m, _ = parallax.design_matrix(training, normed)
+    X, _, _ = parallax.blocked_design_matrix(training, normed, 'bucket/X', block=7)
+
+    # Parallaxes the model can actually fit, so the optimizer converges
+    rs = np.random.RandomState(4)
+    truth = .01*rs.normal(size=dense.shape[1])
+    truth[0] = -1
+    y = np.exp(dense @ truth)*(1 + .01*rs.normal(size=len(dense)))
+    w = 1/(.01*y)**2
+
+    # Started near the truth and without the L1 penalty, so the optimizer converges on so few stars rather
+    # than running off to where the `exp` link is flat
+    b0 = truth + .002*rs.normal(size=len(truth))
+    expected = parallax.train(dense, y, w, m=m, lambd=0, b0=b0)
+    streamed = parallax.train(X, y, w, m=m, lambd=0, b0=b0)
+    np.testing.assert_allclose(streamed, expected, rtol=1e-5, atol=1e-7)
+    # It did actually have to go somewhere
+    assert abs(expected - b0).max() > 1e-3
+
+    predictions = parallax.predict(expected, training, normed, tol=0)
+    np.testing.assert_allclose(parallax.predict(streamed, training, normed, tol=0).values, predictions.values, rtol=1e-5)
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+from parallax import cannon
+
+def _spectra(n=200, pixels=30, seed=0):
+    rs = np.random.RandomState(seed)
+    labels = pd.DataFrame({'teff': rs.normal(4800, 300, n), 'logg': rs.normal(2.5, .5, n)})
+    coeffs = rs.normal(0, .05, (pixels, 3))
+    coeffs[:, 0] += 1
+    model = cannon.Model(coeffs, labels.values.mean(0), labels.values.std(0), labels.columns)
+    ivar = rs.uniform(100, 1000, (n, pixels))
+    return labels, model.predict(labels), ivar, rs
+
+def test_train_matches_pixel_by_pixel_least_squares():
+    labels, flux, ivar, rs = _spectra()
+    flux = flux + rs.normal(size=flux.shape)/np.sqrt(ivar)
+    model = cannon.train(flux, ivar, labels)
+
+    A = model.design(labels)
+    for pixel in range(flux.shape[1]):
+        w = np.sqrt(ivar[:, pixel])
+        expected = np.linalg.lstsq(A*w[:, None], flux[:, pixel]*w, rcond=None)[0]
+        np.testing.assert_allclose(model.coeffs[pixel], expected, rtol=1e-8, atol=1e-10)
+
+def test_recovers_noiseless_labels():
+    labels, flux, ivar, _ = _spectra()
+    model = cannon.train(flux, ivar, labels)
+    inferred, errors = cannon.test(model, pd.DataFrame(flux), ivar)
+    assert list(inferred.columns) == ['teff', 'logg']
+    np.testing.assert_allclose(inferred.values, labels.values, rtol=1e-8)
+    assert (errors.values > 0).all()
+
+def test_label_errors_match_a_single_star():
+    labels, flux, ivar, _ = _spectra(n=50)
+    model = cannon.train(flux, ivar, labels)
+    _, errors = cannon.test(model, flux[:1], ivar[:1])
+
+    # The covariance of one star's standardized labels is the inverse of its weighted normal matrix
+    C = model.coeffs[:, 1:]
+    expected = np.sqrt(np.diag(np.linalg.inv(C.T @ (ivar[0, :, None]*C))))*model.scales
+    np.testing.assert_allclose(errors[0], expected)
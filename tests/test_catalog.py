@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+from parallax import catalog
+
+@pytest.fixture(autouse=True)
+def memory_storage(monkeypatch):
+    monkeypatch.setenv('PARALLAX_STORAGE', 'memory')
+    monkeypatch.setattr(catalog.storage, '_memory', {})
+
+def _frame(x):
+    return pd.concat({'gaia': pd.DataFrame({'parallax': x, 'source_id': np.arange(len(x))})}, axis=1)
+
+def test_round_trip():
+    df = _frame(np.linspace(0, 1, 5))
+    df['tmass', 'tmass_id'] = list('abcde')
+    catalog.store(df, 'bucket/catalog')
+    c = catalog.Catalog('bucket/catalog')
+    assert c.to_frame().equals(df)
+    assert c[c.gaia.parallax > .5].gaia.source_id.tolist() == [3, 4]
+
+def test_version_follows_the_contents():
+    catalog.store(_frame(np.arange(5.)), 'bucket/catalog')
+    first = catalog.Catalog('bucket/catalog')
+
+    catalog.store(_frame(np.arange(5.)), 'bucket/catalog')
+    assert catalog.Catalog('bucket/catalog').version == first.version
+
+    # Same root, same rows, different data
+    catalog.store(_frame(np.arange(5.) + 1), 'bucket/catalog')
+    rebuilt = catalog.Catalog('bucket/catalog')
+    assert rebuilt.version != first.version
+    assert rebuilt[[0, 1]].version != first[[0, 1]].version
+    assert first[[0, 1]].version != first[[1, 2]].version
@@ -0,0 +1,59 @@
+import pandas as pd
+import pytest
+from parallax import dag
+
+@pytest.fixture(autouse=True)
+def memory_storage(monkeypatch):
+    monkeypatch.setenv('PARALLAX_STORAGE', 'memory')
+    monkeypatch.setattr(dag.storage, '_memory', {})
+
+def test_uncached_stage_data_invalidates_downstream():
+    source = {'x': [1., 2.]}
+    calls = []
+    def total(df):
+        calls.append(1)
+        return df.x.sum()
+    stages = [
+        dag.Stage('load', lambda: pd.DataFrame(source), cache=False),
+        dag.Stage('total', total, inputs=['load'])]
+
+    assert dag.run(stages) == {'total': 3.}
+    assert dag.run(stages) == {'total': 3.}
+    assert len(calls) == 1
+    assert dag.stale(stages) == ['load']
+
+    source['x'] = [1., 5.]
+    assert dag.stale(stages) == ['load', 'total']
+    assert dag.run(stages) == {'total': 6.}
+    assert len(calls) == 2
+
+def test_code_covers_imported_modules(tmp_path, monkeypatch):
+    package = tmp_path/'pipeline'
+    package.mkdir()
+    (package/'__init__.py').write_text('')
+    (package/'stages.py').write_text('def fit(x):\n    from .helpers import solve\n    return solve(x)\n')
+    (package/'helpers.py').write_text('def solve(x):\n    return x\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    from pipeline import stages
+
+    stage = dag.Stage('fit', stages.fit)
+    before = stage.code()
+    (package/'helpers.py').write_text('def solve(x):\n    return 2*x\n')
+    assert stage.code() != before
+
+def test_code_ignores_modules_only_the_package_imports(tmp_path, monkeypatch):
+    package = tmp_path/'siblings'
+    package.mkdir()
+    (package/'__init__.py').write_text('from . import stages, other\n')
+    (package/'stages.py').write_text('from . import helpers\ndef fit(x):\n    return helpers.solve(x)\n')
+    (package/'helpers.py').write_text('def solve(x):\n    return x\n')
+    (package/'other.py').write_text('x = 1\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    from siblings import stages
+
+    stage = dag.Stage('fit', stages.fit)
+    before = stage.code()
+    (package/'other.py').write_text('x = 2\n')
+    assert stage.code() == before
+    (package/'helpers.py').write_text('def solve(x):\n    return 2*x\n')
+    assert stage.code() != before
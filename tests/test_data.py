@@ -0,0 +1,65 @@
+import astropy.table
+import numpy as np
+import pytest
+from parallax import data
+
+class FakeJob(object):
+
+    def __init__(self, jobid, results):
+        self.jobid, self.results = jobid, results
+
+    def get_jobid(self):
+        return self.jobid
+
+    def get_phase(self):
+        return 'COMPLETED'
+
+    def get_results(self):
+        return self.results
+
+class FakeTap(object):
+    """Stands in for `astroquery.gaia.Gaia`, matching each uploaded 2MASS ID to one made-up Gaia source"""
+
+    def __init__(self):
+        self.uploads = []
+
+    def launch_job_async(self, query, upload_resource, upload_table_name):
+        ids = [i.decode() if isinstance(i, bytes) else i for i in astropy.table.Table.read(upload_resource)['tmass_id']]
+        self.uploads.append(ids)
+        n = len(ids)
+        results = astropy.table.Table({
+            'tmass_id': np.array([i.encode() for i in ids]),
+            'gaia_start': np.array([b''] * n),
+            'source_id': np.arange(n),
+            'parallax': np.linspace(.1, 1, n),
+            'wise_start': np.array([b''] * n),
+            'designation': np.array([f'J{i}'.encode() for i in ids]),
+            'w1mpro': np.linspace(8, 9, n)})
+        return FakeJob(f'job{len(self.uploads)}', results)
+
+@pytest.fixture(autouse=True)
+def memory_storage(monkeypatch):
+    monkeypatch.setenv('PARALLAX_STORAGE', 'memory')
+    monkeypatch.setattr(data.storage, '_memory', {})
+
+def test_fetch_gaia_chunks_and_caches():
+    ids = [f'{i:016d}' for i in range(7)]
+    tap = FakeTap()
+    df = data.fetch_gaia(ids, chunk_size=3, N=2, tap=tap, poll=0)
+
+    assert sorted(len(u) for u in tap.uploads) == [1, 3, 3]
+    assert sorted(df.tmass.tmass_id) == ids
+    assert list(df.gaia.columns) == ['source_id', 'parallax']
+    assert list(df.wise.columns) == ['designation', 'w1mpro']
+
+    # Every chunk's cached, so a rerun doesn't submit anything
+    again = data.fetch_gaia(ids, chunk_size=3, N=2, tap=tap, poll=0)
+    assert len(tap.uploads) == 3
+    assert again.equals(df)
+
+def test_fetch_gaia_empty():
+    tap = FakeTap()
+    df = data.fetch_gaia([], tap=tap)
+    assert tap.uploads == []
+    assert len(df) == 0
+    assert list(df.columns) == [('tmass', 'tmass_id')]
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from parallax import galactic
+
+def _stars(n=20, seed=0):
+    rs = np.random.RandomState(seed)
+    return dict(
+        ra=rs.uniform(0, 360, n), dec=rs.uniform(-80, 80, n), parallax=rs.uniform(.2, 2, n),
+        pmra=rs.normal(0, 5, n), pmdec=rs.normal(0, 5, n), rv=rs.normal(0, 50, n))
+
+def test_cartesian_matches_astropy():
+    coords = pytest.importorskip('astropy.coordinates')
+    u = pytest.importorskip('astropy.units')
+    s = _stars()
+
+    icrs = coords.ICRS(
+        ra=s['ra']*u.deg, dec=s['dec']*u.deg, distance=(1/s['parallax'])*u.kpc,
+        pm_ra_cosdec=s['pmra']*u.mas/u.yr, pm_dec=s['pmdec']*u.mas/u.yr, radial_velocity=s['rv']*u.km/u.s)
+    frame = coords.Galactocentric(
+        galcen_distance=galactic.X_SUN*u.kpc, z_sun=galactic.Z_SUN*u.kpc,
+        galcen_v_sun=coords.CartesianDifferential(galactic.V_SUN*u.km/u.s), roll=0*u.deg)
+    expected = icrs.transform_to(frame)
+    expected = np.stack([
+        expected.x.to_value(u.kpc), expected.y.to_value(u.kpc), expected.z.to_value(u.kpc),
+        expected.v_x.to_value(u.km/u.s), expected.v_y.to_value(u.km/u.s), expected.v_z.to_value(u.km/u.s)], -1)
+
+    np.testing.assert_allclose(galactic.cartesian(**s), expected, atol=1e-9)
+
+def test_cylindrical_round_trips():
+    cart = galactic.cartesian(**_stars())
+    rho, phi, z, v_rho, v_phi, v_z = galactic.cylindrical(cart).T
+    np.testing.assert_allclose(rho*np.cos(phi), cart[:, 0])
+    np.testing.assert_allclose(rho*np.sin(phi), cart[:, 1])
+    np.testing.assert_allclose(v_rho*np.cos(phi) - v_phi*np.sin(phi), cart[:, 3])
+    np.testing.assert_allclose(v_rho*np.sin(phi) + v_phi*np.cos(phi), cart[:, 4])
+
+def test_sample_moments():
+    s = _stars(n=10)
+    errors = dict(parallax_err=1e-6*s['parallax'], pmra_err=np.full(10, .1), pmdec_err=np.full(10, .1))
+    mean_cart, cov_cart, mean_cyl, cov_cyl = galactic.sample(
+        s['ra'], s['dec'], s['parallax'], errors['parallax_err'], s['pmra'], errors['pmra_err'], 
+        s['pmdec'], errors['pmdec_err'], s['rv'], rv_err=1., n_samples=4096, block=3)
+
+    # With next to no parallax error the positions hardly scatter, and the velocities are linear in the draws
+    np.testing.assert_allclose(mean_cart[:, :3], galactic.cartesian(**s)[:, :3], atol=1e-4)
+    np.testing.assert_allclose(mean_cart[:, 3:], galactic.cartesian(**s)[:, 3:], atol=.2)
+    assert cov_cart.shape == cov_cyl.shape == (10, 3, 3)
+    np.testing.assert_allclose(cov_cart, np.swapaxes(cov_cart, 1, 2))
+    # The total variance is the same in either basis, up to the little the positions - and so the basis - scatter
+    np.testing.assert_allclose(np.trace(cov_cart, axis1=1, axis2=2), np.trace(cov_cyl, axis1=1, axis2=2), rtol=1e-4)
+
+def test_sample_is_seeded():
+    s = _stars(n=7)
+    args = (s['ra'], s['dec'], s['parallax'], .1*s['parallax'], s['pmra'], np.ones(7), s['pmdec'], np.ones(7), s['rv'])
+    whole = galactic.sample(*args, n_samples=64, block=100)
+    again = galactic.sample(*args, n_samples=64, block=100)
+    for a, b in zip(whole, again):
+        np.testing.assert_array_equal(a, b)
+
+def test_sample_leaves_negative_parallaxes_out():
+    s = _stars(n=3)
+    # Half of the first star's parallax draws are negative, so have no distance
+    parallax_err = np.array([1., 1e-3, 1e-3])
+    s['parallax'][0] = 0.
+    mean_cart, cov_cart, _, _ = galactic.sample(
+        s['ra'], s['dec'], s['parallax'], parallax_err, s['pmra'], np.ones(3), s['pmdec'], np.ones(3), s['rv'],
+        n_samples=256)
+    assert np.isfinite(mean_cart).all()
+    assert np.isfinite(cov_cart).all()
@@ -0,0 +1,22 @@
+import sys
+import subprocess
+import pytest
+
+HEAVY = ['pandas', 'tqdm', 'boto3', 'matplotlib']
+
+def test_import_is_light():
+    # Every worker `tools.parallel` starts pays for this import, so it mustn't drag in the heavy libraries
+    code = f'import sys, parallax; print(",".join(m for m in {HEAVY!r} if m in sys.modules))'
+    loaded = subprocess.check_output([sys.executable, '-c', code], text=True).strip()
+    assert loaded == ''
+
+@pytest.mark.parametrize('name', ['tools', 'data'])
+def test_submodules_load_on_use(name):
+    code = f'import sys, parallax; parallax.{name}; print("parallax.{name}" in sys.modules)'
+    assert subprocess.check_output([sys.executable, '-c', code], text=True).strip() == 'True'
+
+def test_tools_is_light():
+    # `tools` is what the workers of `tools.parallel` import to unpickle their tasks
+    code = f'import sys, parallax.tools; print(",".join(m for m in {HEAVY!r} if m in sys.modules))'
+    loaded = subprocess.check_output([sys.executable, '-c', code], text=True).strip()
+    assert loaded == ''
@@ -0,0 +1,35 @@
+import json
+import logging
+import pytest
+from parallax import metrics
+
+@metrics.timed(items=len)
+def _work(n):
+    return list(range(n))
+
+def test_nothing_recorded_by_default(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(metrics, 'PATH', None)
+    assert _work(3) == [0, 1, 2]
+    assert list(tmp_path.iterdir()) == []
+
+def test_records_when_asked(monkeypatch, tmp_path):
+    path = tmp_path / 'logs' / 'metrics.jsonl'
+    monkeypatch.setattr(metrics, 'PATH', str(path))
+    _work(3)
+    [record] = [json.loads(l) for l in path.read_text().splitlines()]
+    assert record['stage'] == '_work'
+    assert record['items'] == 3
+
+def test_unwritable_path_only_warns(monkeypatch, tmp_path, caplog):
+    # A directory can't be appended to
+    monkeypatch.setattr(metrics, 'PATH', str(tmp_path))
+    with caplog.at_level(logging.WARNING, logger=metrics.__name__):
+        assert _work(2) == [0, 1]
+    assert 'metrics' in caplog.text
+
+def test_unwritable_path_doesnt_mask_errors(monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, 'PATH', str(tmp_path))
+    with pytest.raises(KeyError):
+        with metrics.stage('failing'):
+            raise KeyError()
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from parallax import catalog as catalogs, parallax
+
+def _model(X, seed=1):
+    b = .01*np.random.RandomState(seed).normal(size=X.shape[1])
+    b[0] = -1
+    return b
+
+def _reference(b, catalog, normed):
+    """What `predict` should give, from the whole design matrix and error matrix at once"""
+    X, m, _ = parallax.design_matrix(catalog, normed)
+    E2 = parallax.design_errors(catalog, normed)**2 * b**2
+    y = np.exp(X @ b)
+    return y, y*np.sqrt(E2.sum(1)), y*np.sqrt(E2[:, m == 0].sum(1)), y*np.sqrt(E2[:, m == 1].sum(1))
+
+@pytest.mark.parametrize('store', [False, True])
+def test_predict_in_blocks_matches_all_at_once(stars, memory_storage, store):
+    catalog, normed = stars
+    if store:
+        catalogs.store(catalog, 'bucket/catalog')
+        catalog = catalogs.Catalog('bucket/catalog')
+    b = _model(parallax.design_matrix(catalog, normed)[0])
+
+    whole = parallax.predict(b, catalog, normed, block=len(catalog), tol=0)
+    blocked = parallax.predict(b, catalog, normed, block=7, tol=0)
+    assert list(blocked.index) == list(catalog.index)
+    np.testing.assert_allclose(blocked.values, whole.values, rtol=1e-12)
+
+    y, error, photometric, spectral = _reference(b, catalog, normed)
+    np.testing.assert_allclose(blocked.parallax, y)
+    np.testing.assert_allclose(blocked.error, error)
+    np.testing.assert_allclose(blocked.error_photometric, photometric)
+    np.testing.assert_allclose(blocked.error_spectral, spectral)
+    # The last few stars have no spectrum
+    assert blocked.parallax.isnull().sum() == 3
+
+def test_predict_from_stored_spectra(stars, memory_storage):
+    from parallax import data
+    catalog, normed = stars
+    b = _model(parallax.design_matrix(catalog, normed)[0])
+    stored = data.store_spectra(normed, root='bucket/spectra')
+    assert stored.to_frame().equals(normed)
+
+    np.testing.assert_allclose(
+        parallax.predict(b, catalog, stored, block=11).values, 
+        parallax.predict(b, catalog, normed, block=11).values)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from parallax import rotation
+
+@pytest.fixture(autouse=True)
+def memory_storage(monkeypatch):
+    monkeypatch.setenv('PARALLAX_STORAGE', 'memory')
+    monkeypatch.setattr(rotation.storage, '_memory', {})
+
+def _curve():
+    R = np.linspace(5, 15, 12)
+    vc = rotation.MODELS['virial']([7e11, 12.], R, rotation.vc_stars(R)**2)
+    return R, vc, np.full_like(R, 5.)
+
+def test_virial_mass_is_enclosed_at_the_virial_radius():
+    M_vir, c = 1e12, 10.
+    R_vir = np.cbrt(M_vir/200/rotation.RHO_C/(4*np.pi/3))
+    vc = rotation.vc_nfw_virial(R_vir, M_vir, c)
+    np.testing.assert_allclose(vc**2, rotation.G*M_vir/R_vir)
+
+BOUNDS = {
+    'nfw': ([1., 1e6], [50., 1e8]),
+    'virial': ([1e10, 0.], [1e15, 50.]),
+    'linear': ([-50., 0.], [50., 400.])}
+
+@pytest.mark.parametrize('model', list(BOUNDS))
+def test_log_prob_matches_walker_by_walker(model):
+    R, vc, sigma = _curve()
+    vc[3] = np.nan
+    lower, upper = BOUNDS[model]
+    f = rotation.LogProb(model, R, vc, sigma, lower, upper)
+    walkers = rotation.initial_uniform(20, lower, upper)
+    walkers[0, 0] = upper[0] + 1
+
+    def scalar(theta):
+        if not ((np.array(lower) < theta) & (theta < np.array(upper))).all():
+            return -np.inf
+        fit = np.array([rotation.MODELS[model](theta, r, rotation.vc_stars(r)**2) for r in R])
+        return np.nansum(-.5*(fit - vc)**2/sigma**2)
+
+    expected = [scalar(w) for w in walkers]
+    np.testing.assert_allclose(f(walkers), expected)
+    np.testing.assert_allclose(f(walkers[1]), expected[1])
+    assert f(walkers[0]) == -np.inf
+
+def test_resumed_chain_matches_an_uninterrupted_one():
+    pytest.importorskip('emcee')
+    R, vc, sigma = _curve()
+    p0 = rotation.initial_ball(8, [7e11, 12.])
+    kwargs = dict(lower=[1e10, 0], upper=[1e15, 50], checkpoint=5, progress=False)
+
+    whole, whole_lp = rotation.sample('virial', R, vc, sigma, p0, n_steps=20, **kwargs)
+    rotation.sample('virial', R, vc, sigma, p0, n_steps=10, path='bucket/chain', **kwargs)
+    resumed, resumed_lp = rotation.sample('virial', R, vc, sigma, p0, n_steps=20, path='bucket/chain', **kwargs)
+
+    assert whole.shape == (20, 8, 2)
+    np.testing.assert_array_equal(resumed, whole)
+    np.testing.assert_array_equal(resumed_lp, whole_lp)
@@ -0,0 +1,35 @@
+import os
+import threading
+import numpy as np
+import pytest
+from parallax.aws import storage
+
+def test_environment_overrides_a_missing_config(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PARALLAX_STORAGE', 'memory')
+    assert isinstance(storage.Path('bucket/key'), storage.MemoryPath)
+
+def test_concurrent_local_writes_dont_clobber(tmp_path):
+    path = storage.LocalPath('bucket/key', root=tmp_path)
+    payloads = [bytes([i])*2**20 for i in range(8)]
+    threads = [threading.Thread(target=path.write_bytes, args=(p,)) for p in payloads]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert path.read_bytes() in payloads
+    assert os.listdir(tmp_path / 'bucket') == ['key']
+
+def test_failed_local_write_leaves_nothing(tmp_path):
+    path = storage.LocalPath('bucket/key', root=tmp_path)
+    with pytest.raises(IOError):
+        with path.write_multipart() as write:
+            write(b'half')
+            raise ValueError()
+    assert os.listdir(tmp_path / 'bucket') == []
+
+def test_local_arrays_memmap(tmp_path):
+    path = storage.LocalPath('bucket/key', root=tmp_path)
+    path.write_array(np.arange(10.))
+    assert (path.memmap() == np.arange(10.)).all()
@@ -0,0 +1,92 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+import pytest
+from parallax import tools
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(tools, '_masks', tools.OrderedDict())
+    monkeypatch.setattr(tools, '_survival', {})
+
+def test_cut_frames_sharing_an_index():
+    cuts = {'positive': lambda c: c.x > 0}
+    passing = pd.DataFrame({'x': [1., 2.]})
+    failing = pd.DataFrame({'x': [-1., -2.]}, index=passing.index)
+
+    assert len(tools.cut(passing, cuts)) == 2
+    assert len(tools.cut(failing, cuts)) == 0
+
+def test_cut_reordering_hits_the_cache():
+    df = pd.DataFrame({'x': np.arange(100.), 'y': np.arange(100.) % 10})
+    cuts = {'x': lambda c: c.x < 90, 'y': lambda c: c.y < 2}
+
+    first, report = tools.cut(df, cuts, report=True)
+    assert report.evaluated.to_dict() == {'x': 100, 'y': 90}
+
+    # `y` cut more, so it goes first this time. It only has to be evaluated on the rows `x` cut away last 
+    # time, and `x` sees a different set of rows - all of which it's already been evaluated on.
+    second, report = tools.cut(df, cuts, report=True)
+    assert list(report.index) == ['y', 'x']
+    assert report.evaluated.to_dict() == {'y': 10, 'x': 0}
+    assert second.equals(first)
+    assert list(second.index) == [i for i in range(90) if i % 10 < 2]
+
+def test_cut_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(tools, 'CACHE_SIZE', 3)
+    for i in range(10):
+        tools.cut(pd.DataFrame({'x': np.arange(10.) + i}), {'x': lambda c: c.x > 5})
+    assert len(tools._masks) == 3
+
+def _fails_on_odd(x):
+    if x % 2:
+        raise ValueError(x)
+    return 10*x
+
+@pytest.mark.parametrize('kwargs', [{'N': 0}, {'N': 2, 'processes': False}])
+def test_parallel_records_failures_in_place(kwargs):
+    with tools.parallel(_fails_on_odd, errors='record', progress=False, **kwargs) as p:
+        listed = p.wait([p(x) for x in range(4)])
+        keyed = p.wait({x: p(x) for x in range(4)})
+        failures = p.failures
+    assert listed == [0, None, 20, None]
+    assert keyed == {0: 0, 2: 20}
+    assert sorted(failures) == [1, 3]
+    assert all(isinstance(e, ValueError) for e in failures.values())
+
+def test_parallel_raises_by_default_on_the_serial_path():
+    with pytest.raises(ValueError):
+        with tools.parallel(_fails_on_odd, N=0, progress=False) as p:
+            p.wait([p(x) for x in range(4)])
+
+def _big(i):
+    return np.full(300000, float(i))
+
+def _blocks():
+    return set(glob.glob('/dev/shm/psm_*'))
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='Needs POSIX shared memory')
+def test_parallel_frees_uncollected_result_blocks():
+    before = _blocks()
+    with tools.parallel(_big, N=2, progress=False) as p:
+        futures = [p(i) for i in range(4)]
+    with tools.parallel(_big, N=2, progress=False) as p:
+        for result in p.imap(range(6)):
+            break
+    assert _blocks() - before == set()
+
+def _traffic(n):
+    tools.aws.BYTES['read'] += n
+    return n
+
+@pytest.mark.parametrize('kwargs', [{'N': 2}, {'N': 2, 'processes': False}, {'N': 0}])
+def test_parallel_counts_worker_storage_traffic(kwargs):
+    before = tools.aws.BYTES['read']
+    with tools.parallel(_traffic, progress=False, **kwargs) as p:
+        p.wait([p(n) for n in [1, 10, 100]])
+        tasks = p.summary.tasks()
+    assert tools.aws.BYTES['read'] - before == 111
+    if kwargs.get('processes', True):
+        # Threads share the counters, so only the total is exact for them
+        assert sorted(tasks.bytes_read) == [1, 10, 100]
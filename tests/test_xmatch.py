@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+from parallax import xmatch
+
+def _separation(ra1, dec1, ra2, dec2):
+    """Angular separation in arcseconds, by the haversine formula"""
+    ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
+    h = np.sin((dec2 - dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2
+    return np.degrees(2*np.arcsin(np.sqrt(h)))*3600
+
+def _sky(n, seed):
+    rs = np.random.RandomState(seed)
+    return rs.uniform(0, 360, n), np.degrees(np.arcsin(rs.uniform(-1, 1, n)))
+
+def test_query_matches_brute_force():
+    ra, dec = _sky(2000, 0)
+    rs = np.random.RandomState(1)
+    # Half the queries are jittered copies of sources, and half are wherever
+    qra, qdec = _sky(200, 2)
+    qra[:100] = ra[:100] + rs.normal(0, 1e-4, 100)/np.cos(np.radians(dec[:100]))
+    qdec[:100] = np.clip(dec[:100] + rs.normal(0, 1e-4, 100), -90, 90)
+
+    idx, sep = xmatch.SkyIndex(ra, dec).query(qra, qdec, radius=2.)
+    for i in range(len(qra)):
+        seps = _separation(qra[i], qdec[i], ra, dec)
+        if seps.min() < 2.:
+            assert idx[i] == seps.argmin()
+            np.testing.assert_allclose(sep[i], seps.min(), atol=1e-6)
+        else:
+            assert idx[i] == -1 and np.isnan(sep[i])
+    assert (idx[:100] == np.arange(100)).all()
+
+def test_query_radius_matches_brute_force():
+    ra, dec = _sky(5000, 3)
+    qra, qdec = ra[:20] + 1e-3, dec[:20]
+    found = xmatch.SkyIndex(ra, dec).query_radius(qra, qdec, radius=600.)
+    for i, f in enumerate(found):
+        expected = np.flatnonzero(_separation(qra[i], qdec[i], ra, dec) < 600.)
+        np.testing.assert_array_equal(np.sort(f), expected)
+
+def test_propagation_recovers_moving_sources():
+    ra, dec = np.array([10., 200.]), np.array([45., -30.])
+    pmra, pmdec = np.array([500., -800.]), np.array([-300., 1000.])
+    # Where they were 15 years before Gaia's epoch
+    ra_2000, dec_2000 = xmatch.propagate(ra, dec, pmra, pmdec, -15.5)
+    assert (_separation(ra, dec, ra_2000, dec_2000) > 5).all()
+
+    index = xmatch.SkyIndex(ra, dec, pmra, pmdec, epoch=2015.5)
+    assert (index.query(ra_2000, dec_2000, radius=1.)[0] == -1).all()
+    idx, sep = index.query(ra_2000, dec_2000, radius=1., epoch=2000.)
+    assert idx.tolist() == [0, 1]
+    assert (sep < 1e-6).all()
+
+def test_match_keeps_matched_rows():
+    left = pd.DataFrame({'ra': [10., 20., 30.], 'dec': [0., 0., 0.], 'id': ['a', 'b', 'c']})
+    right = pd.DataFrame({'ra': [30., 10. + 1e-4], 'dec': [1e-4, 0.], 'source_id': [3, 1]})
+    matched = xmatch.match(left, right, names=('apogee', 'gaia'))
+    assert matched.apogee.id.tolist() == ['a', 'c']
+    assert matched.gaia.source_id.tolist() == [1, 3]
+    np.testing.assert_allclose(matched.xmatch.separation, [.36, .36], rtol=1e-6)